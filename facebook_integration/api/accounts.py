@@ -0,0 +1,115 @@
+import frappe
+from frappe.utils.password import get_decrypted_password
+
+ROUTING_CACHE_KEY = "facebook_account_routing"
+ROUTING_VERSION_KEY = "facebook_account_routing_version"
+ACCOUNT_CONTEXT_KEY = "facebook_account_context"
+
+ACCOUNT_CONTEXT_FIELDS = (
+	"name", "account_name", "enabled", "company", "page_id", "page_name", "app_id",
+	"verify_token", "ad_account_id", "default_lead_owner", "default_warehouse",
+)
+
+FEATURE_FIELDS = ("enable_leads", "enable_messenger", "enable_shop", "enable_ads")
+
+# Compiled routing tables kept in this worker process, keyed by site
+_local_routing = {}
+
+def get_routing_table():
+	"""Return the compiled page_id / verify_token routing table
+
+	The table is cached in Redis and in process memory. A version stamp in
+	Redis tells processes when their copy is stale, so routing a delivery
+	needs no database query once the table is warm.
+	"""
+	cache = frappe.cache()
+	version = cache.get_value(ROUTING_VERSION_KEY)
+	if not version:
+		version = bump_routing_version()
+
+	local = _local_routing.get(frappe.local.site)
+	if local and local.version == version:
+		return local
+
+	table = cache.get_value(ROUTING_CACHE_KEY)
+	if not table or table.version != version:
+		table = build_routing_table(version)
+		cache.set_value(ROUTING_CACHE_KEY, table)
+
+	_local_routing[frappe.local.site] = table
+	return table
+
+def build_routing_table(version):
+	"""Compile enabled Facebook Accounts into lookup maps"""
+	table = frappe._dict(version=version, pages={}, verify_tokens={}, accounts={}, signing_keys={})
+
+	accounts = frappe.get_all("Facebook Account",
+		filters={"enabled": 1},
+		fields=["name", "page_id", "verify_token", *FEATURE_FIELDS])
+
+	for account in accounts:
+		route = frappe._dict(
+			name=account.name,
+			page_id=account.page_id,
+			features=frappe._dict({field: frappe.utils.cint(account.get(field)) for field in FEATURE_FIELDS}),
+			app_secret=get_decrypted_password("Facebook Account", account.name, "app_secret", raise_exception=False),
+			access_token=get_decrypted_password("Facebook Account", account.name, "access_token", raise_exception=False)
+		)
+
+		table.accounts[account.name] = route
+		if account.page_id:
+			table.pages.setdefault(account.page_id, route)
+		if account.verify_token:
+			table.verify_tokens.setdefault(account.verify_token, account.name)
+		if route.app_secret:
+			# HMAC keys are stored pre-encoded; several pages may share one app
+			table.signing_keys.setdefault(route.app_secret.encode(), set()).add(account.name)
+
+	legacy_secret = get_decrypted_password("Facebook Settings", "Facebook Settings", "app_secret", raise_exception=False)
+	table.legacy_signing_key = legacy_secret.encode() if legacy_secret else None
+
+	return table
+
+def bump_routing_version():
+	version = frappe.generate_hash(length=12)
+	frappe.cache().set_value(ROUTING_VERSION_KEY, version)
+	return version
+
+def clear_routing_cache():
+	"""Invalidate the routing table in Redis and, through the version stamp, in every process"""
+	bump_routing_version()
+	frappe.cache().delete_value([ROUTING_CACHE_KEY, ACCOUNT_CONTEXT_KEY])
+	_local_routing.pop(frappe.local.site, None)
+
+def get_account_context(account_name):
+	"""Return the configuration of a Facebook Account with its decrypted access token
+	
+	Loaded once and cached in Redis (and for the rest of the request or job in
+	memory), so hot loops need no document loads or password decrypts. Saving
+	the account invalidates the cache.
+	"""
+	if not isinstance(account_name, str):
+		# Already a context or document
+		return account_name
+	
+	return frappe.cache().hget(ACCOUNT_CONTEXT_KEY, account_name,
+		generator=lambda: build_account_context(account_name))
+
+def build_account_context(account_name):
+	values = frappe.db.get_value("Facebook Account", account_name,
+		[*ACCOUNT_CONTEXT_FIELDS, *FEATURE_FIELDS], as_dict=True)
+	if not values:
+		frappe.throw(frappe._("Facebook Account {0} not found").format(account_name), frappe.DoesNotExistError)
+	
+	values.access_token = get_decrypted_password("Facebook Account", account_name, "access_token", raise_exception=False)
+	return values
+
+def get_route_by_page_id(page_id):
+	if not page_id:
+		return None
+	return get_routing_table().pages.get(str(page_id))
+
+def get_account_by_verify_token(token):
+	if not token:
+		return None
+	return get_routing_table().verify_tokens.get(token)
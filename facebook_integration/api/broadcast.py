@@ -0,0 +1,188 @@
+import frappe
+import json
+import time
+from frappe import _
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.api.conversations import set_message_conversation, update_conversations
+from facebook_integration.api.graph import get_graph_client
+from facebook_integration.api.messaging import SendRateLimiter, enqueue_outbound_sender, send_queued_message
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import Lease, SiteThreadPool, bulk_insert_docs
+
+# Broadcasts
+# ----------
+# A broadcast renders one message per recipient and sends them through a
+# bounded pool of sender threads sharing the page's send rate with the
+# outbound sender. Results are written per chunk as Facebook Message Logs
+# with one bulk insert. Messages that hit a temporary error are handed to the
+# outbound queue for retry. A running broadcast holds a lease; a scheduler
+# backstop resumes Running broadcasts whose lease expired after the chunks
+# already recorded.
+
+BROADCAST_CHUNK_SIZE = 200
+# Sender threads per broadcast, `facebook_broadcast_concurrency` site config key
+DEFAULT_BROADCAST_CONCURRENCY = 8
+BROADCAST_TIMEOUT = 6 * 60 * 60
+
+def get_broadcast_concurrency():
+	return frappe.utils.cint(frappe.conf.get("facebook_broadcast_concurrency")) or DEFAULT_BROADCAST_CONCURRENCY
+
+@frappe.whitelist()
+def broadcast_message(account_name, message_template, recipient_ids=None, filters=None):
+	"""Send a message to many recipients in the background
+	
+	Recipients are either explicit PSIDs or the senders of the account's
+	incoming Facebook Message Logs matching `filters`. Returns the Facebook
+	Broadcast that records the run.
+	"""
+	account = get_account_context(account_name)
+	if not account.enabled or not account.enable_messenger:
+		frappe.throw(_("Messenger integration is not enabled"))
+	
+	recipients = get_broadcast_recipients(account_name, frappe.parse_json(recipient_ids), frappe.parse_json(filters))
+	if not recipients:
+		frappe.throw(_("No recipients to broadcast to"))
+	
+	broadcast = frappe.new_doc("Facebook Broadcast")
+	broadcast.facebook_account = account_name
+	broadcast.message_template = message_template
+	broadcast.recipients = frappe.as_json(recipients, indent=None)
+	broadcast.total_recipients = len(recipients)
+	broadcast.insert()
+	enqueue_broadcast(broadcast.name)
+	
+	return {"success": True, "broadcast": broadcast.name, "total": len(recipients)}
+
+def enqueue_broadcast(broadcast_name):
+	enqueue_event_job("sync", "facebook_integration.api.broadcast.run_broadcast",
+		broadcast_name=broadcast_name,
+		job_id=f"facebook_broadcast|{broadcast_name}",
+		deduplicate=True,
+		timeout=BROADCAST_TIMEOUT,
+		enqueue_after_commit=True)
+
+def resume_stalled_broadcasts():
+	"""Scheduler backstop: resume Running broadcasts whose worker died"""
+	cache = frappe.cache()
+	for broadcast_name in frappe.get_all("Facebook Broadcast", filters={"status": "Running"}, pluck="name"):
+		if not cache.exists(cache.make_key(get_broadcast_lease_name(broadcast_name))):
+			enqueue_broadcast(broadcast_name)
+
+def get_broadcast_lease_name(broadcast_name):
+	return f"facebook_broadcast|{broadcast_name}"
+
+def get_broadcast_recipients(account_name, recipient_ids=None, filters=None):
+	"""Return [{recipient_id, sender_name}] without duplicates"""
+	if recipient_ids:
+		return [{"recipient_id": psid, "sender_name": None} for psid in dict.fromkeys(recipient_ids) if psid]
+	
+	if isinstance(filters, (list, tuple)):
+		filters = [*filters, ["facebook_account", "=", account_name], ["direction", "=", "incoming"]]
+	else:
+		filters = {**(filters or {}), "facebook_account": account_name, "direction": "incoming"}
+	
+	return frappe.get_list("Facebook Message Log",
+		filters=filters,
+		fields=["sender_id as recipient_id", "max(sender_name) as sender_name"],
+		group_by="sender_id",
+		order_by="sender_id asc",
+		limit_page_length=0)
+
+def run_broadcast(broadcast_name):
+	"""Send a broadcast chunk by chunk and record its results and throughput
+	
+	A Running broadcast is resumed after the recipients already counted.
+	"""
+	lease = Lease(get_broadcast_lease_name(broadcast_name))
+	if not lease.acquire():
+		return
+	try:
+		send_broadcast(broadcast_name)
+	finally:
+		lease.release()
+
+def send_broadcast(broadcast_name):
+	broadcast = frappe.get_doc("Facebook Broadcast", broadcast_name)
+	if broadcast.status not in ("Queued", "Running"):
+		return
+	
+	recipients = json.loads(broadcast.recipients or "[]")
+	counts = {field: frappe.utils.cint(broadcast.get(field)) for field in ("sent", "failed", "retrying")}
+	started = time.monotonic() - frappe.utils.flt(broadcast.duration)
+	
+	if broadcast.status == "Queued":
+		set_broadcast_state(broadcast_name, status="Running", started_at=frappe.utils.now())
+		frappe.db.commit()
+	
+	try:
+		account = get_account_context(broadcast.facebook_account)
+		client = get_graph_client(account)
+		limiter = SendRateLimiter(account.page_id or account.name)
+		with SiteThreadPool(max_workers=get_broadcast_concurrency()) as pool:
+			for start in range(sum(counts.values()), len(recipients), BROADCAST_CHUNK_SIZE):
+				messages = [
+					{**recipient, "content": render_broadcast_message(broadcast.message_template, recipient)}
+					for recipient in recipients[start:start + BROADCAST_CHUNK_SIZE]
+				]
+				futures = [pool.submit(send_broadcast_message, client, limiter, message) for message in messages]
+				results = [future.result() for future in futures]
+				save_broadcast_results(broadcast, account, messages, results, counts)
+				set_broadcast_state(broadcast_name, **counts, **get_throughput(started, counts))
+				frappe.db.commit()
+		
+		set_broadcast_state(broadcast_name, status="Completed", finished_at=frappe.utils.now(),
+			**get_throughput(started, counts))
+	except Exception as e:
+		frappe.db.rollback()
+		frappe.log_error(f"Facebook broadcast {broadcast_name} failed: {str(e)}")
+		set_broadcast_state(broadcast_name, status="Failed", error=str(e), finished_at=frappe.utils.now(),
+			**get_throughput(started, counts))
+	
+	frappe.db.commit()
+	
+	if counts["retrying"]:
+		enqueue_outbound_sender(broadcast.facebook_account)
+
+def render_broadcast_message(template, recipient):
+	if "{" not in template:
+		return template
+	return frappe.render_template(template, recipient)
+
+def send_broadcast_message(client, limiter, message):
+	limiter.wait()
+	return send_queued_message(client, frappe._dict(
+		recipient_id=message["recipient_id"],
+		content=message["content"],
+		send_attempts=0
+	))
+
+def save_broadcast_results(broadcast, account, messages, results, counts):
+	"""Store one Facebook Message Log per message with one bulk insert"""
+	rows = []
+	for message, result in zip(messages, results):
+		status = result.get("status") or "queued"
+		counts["retrying" if status == "queued" else status] += 1
+		rows.append(set_message_conversation({
+			"facebook_account": broadcast.facebook_account,
+			"broadcast": broadcast.name,
+			"sender_id": account.page_id,
+			"recipient_id": message["recipient_id"],
+			"content": message["content"],
+			"direction": "outgoing",
+			"message_type": "text",
+			**result,
+			"status": status
+		}))
+	bulk_insert_docs("Facebook Message Log", rows)
+	update_conversations(rows)
+
+def get_throughput(started, counts):
+	duration = time.monotonic() - started
+	attempted = sum(counts.values())
+	return {
+		"duration": round(duration, 3),
+		"throughput": round(attempted / duration, 3) if duration else 0
+	}
+
+def set_broadcast_state(broadcast_name, **values):
+	frappe.db.set_value("Facebook Broadcast", broadcast_name, values, update_modified=False)
@@ -0,0 +1,153 @@
+import frappe
+import re
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import bulk_insert_docs
+
+# Duplicate matching
+# -----------------
+# Facebook Contact Index maps normalized emails and phone numbers of Leads,
+# Contacts and Customers to the documents holding them. It is kept current
+# by doc_events, so an incoming lead is matched with one indexed IN query
+# instead of creating a duplicate record.
+
+INDEX_DOCTYPE = "Facebook Contact Index"
+
+# Indexed doctype -> {field: key type}
+INDEXED_FIELDS = {
+	"Lead": {"email_id": "Email", "mobile_no": "Phone", "phone": "Phone"},
+	"Contact": {"email_id": "Email", "mobile_no": "Phone", "phone": "Phone"},
+	"Customer": {"email_id": "Email", "mobile_no": "Phone"},
+}
+
+REBUILD_PAGE_SIZE = 1000
+MIN_PHONE_DIGITS = 7
+
+def normalize_email(email):
+	email = (email or "").strip().lower()
+	return email if "@" in email else None
+
+def normalize_phone(phone):
+	"""Keep the digits only, so "+880 1712-000000" and "008801712000000" match"""
+	digits = re.sub(r"\D", "", phone or "").lstrip("0")
+	return digits if len(digits) >= MIN_PHONE_DIGITS else None
+
+def get_match_key(key_type, value):
+	value = normalize_email(value) if key_type == "Email" else normalize_phone(value)
+	return f"{key_type.lower()}:{value}" if value else None
+
+def get_match_keys(email=None, phone=None):
+	"""Return the match keys of an email and phone, email first"""
+	return [key for key in (get_match_key("Email", email), get_match_key("Phone", phone)) if key]
+
+def get_document_keys(doctype, doc):
+	"""Return {match key: key type} for the indexed fields of a document"""
+	keys = {}
+	for field, key_type in INDEXED_FIELDS[doctype].items():
+		key = get_match_key(key_type, doc.get(field))
+		if key:
+			keys.setdefault(key, key_type)
+	return keys
+
+def match_documents(doctype, contacts):
+	"""Find existing documents for a list of (email, phone) pairs
+	
+	Returns one document name or None per pair, in order. An email match
+	wins over a phone match; the oldest indexed document wins a tie.
+	"""
+	contact_keys = [get_match_keys(email, phone) for email, phone in contacts]
+	all_keys = list({key for keys in contact_keys for key in keys})
+	if not all_keys:
+		return [None] * len(contacts)
+	
+	matches = {}
+	for row in frappe.get_all(INDEX_DOCTYPE,
+		filters={"reference_doctype": doctype, "match_key": ["in", all_keys]},
+		fields=["match_key", "reference_name"],
+		order_by="creation asc"):
+		matches.setdefault(row.match_key, row.reference_name)
+	
+	return [next((matches[key] for key in keys if key in matches), None) for keys in contact_keys]
+
+def update_contact_index(doc, method=None):
+	"""doc_events hook: keep the index entries of a Lead, Contact or Customer current"""
+	if doc.doctype in INDEXED_FIELDS:
+		sync_index_entries(doc.doctype, [doc])
+
+def sync_index_entries(doctype, docs):
+	"""Make the index entries of `docs` match their current fields
+	
+	Missing entries are inserted and stale ones deleted; entries that are
+	still valid are left in place.
+	"""
+	wanted = {
+		(doc.name, key): key_type
+		for doc in docs
+		for key, key_type in get_document_keys(doctype, doc).items()
+	}
+	entries = frappe.get_all(INDEX_DOCTYPE,
+		filters={"reference_doctype": doctype, "reference_name": ["in", [doc.name for doc in docs]]},
+		fields=["name", "match_key", "reference_name"])
+	
+	stale = [entry.name for entry in entries if (entry.reference_name, entry.match_key) not in wanted]
+	if stale:
+		frappe.db.delete(INDEX_DOCTYPE, {"name": ["in", stale]})
+	
+	indexed = {(entry.reference_name, entry.match_key) for entry in entries}
+	bulk_insert_docs(INDEX_DOCTYPE, [
+		get_index_row(doctype, name, key, key_type)
+		for (name, key), key_type in wanted.items() if (name, key) not in indexed
+	])
+
+def remove_from_contact_index(doc, method=None):
+	"""doc_events hook: drop the index entries of a deleted document"""
+	if doc.doctype in INDEXED_FIELDS:
+		frappe.db.delete(INDEX_DOCTYPE, {"reference_doctype": doc.doctype, "reference_name": doc.name})
+
+def get_index_row(doctype, name, key, key_type):
+	return {
+		"match_key": key,
+		"key_type": key_type,
+		"reference_doctype": doctype,
+		"reference_name": name
+	}
+
+@frappe.whitelist()
+def rebuild_contact_index():
+	"""Rebuild the duplicate-matching index from existing records in the background"""
+	frappe.only_for("System Manager")
+	enqueue_event_job("sync", "facebook_integration.api.contacts.build_contact_index",
+		job_id="facebook_contact_index_rebuild",
+		deduplicate=True,
+		timeout=3600)
+	return {"success": True}
+
+def build_contact_index():
+	"""Index every Lead, Contact and Customer, one page per transaction
+	
+	Entries are brought up to date page by page and entries of deleted
+	documents are pruned last, so matching keeps working during a rebuild.
+	"""
+	for doctype, fields in INDEXED_FIELDS.items():
+		if not frappe.db.exists("DocType", doctype):
+			continue
+		
+		start = 0
+		while True:
+			docs = frappe.get_all(doctype,
+				fields=["name", *fields],
+				order_by="name asc",
+				limit_start=start,
+				limit_page_length=REBUILD_PAGE_SIZE)
+			if not docs:
+				break
+			
+			sync_index_entries(doctype, docs)
+			frappe.db.commit()
+			start += REBUILD_PAGE_SIZE
+		
+		frappe.db.sql(f"""
+			delete from `tab{INDEX_DOCTYPE}`
+			where reference_doctype = %s
+				and reference_name not in (select name from `tab{doctype}`)
+		""", doctype)
+		frappe.db.commit()
@@ -0,0 +1,159 @@
+import frappe
+from frappe import _
+from facebook_integration.utils import get_keyset_filters, get_next_cursor, get_page_size
+
+# Conversations
+# -------------
+# Facebook Conversation holds one row per (account, PSID) with the last
+# message preview, the last activity time and the unread count. Rows are
+# upserted with one multi-row statement whenever message logs are written,
+# so the inbox is a single indexed scan instead of a regroup of the log.
+
+PREVIEW_LENGTH = 140
+
+# Columns returned by the inbox and change APIs
+CONVERSATION_LIST_FIELDS = [
+	"name", "facebook_account", "psid", "sender_name", "last_message_preview",
+	"last_message_at", "last_direction", "unread_count",
+]
+
+CONVERSATION_FIELDS = (
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"facebook_account", "psid", "sender_name", "last_message_at", "last_direction",
+	"unread_count", "last_message_preview",
+)
+
+def get_conversation_psid(msg_log):
+	return msg_log.get("sender_id") if msg_log.get("direction") == "incoming" else msg_log.get("recipient_id")
+
+def get_conversation_name(account_name, psid):
+	return f"{account_name}-{psid}"
+
+def set_message_conversation(msg_log):
+	"""Set the conversation link of a message log row before it is inserted"""
+	psid = get_conversation_psid(msg_log)
+	if msg_log.get("facebook_account") and psid:
+		msg_log.update({"conversation": get_conversation_name(msg_log.get("facebook_account"), psid)})
+	return msg_log
+
+def get_message_preview(msg_log):
+	content = msg_log.get("content")
+	if not content and msg_log.get("message_type") not in (None, "text"):
+		content = f"[{msg_log.get('message_type')}]"
+	return (content or "")[:PREVIEW_LENGTH]
+
+def update_conversations(message_logs, count_unread=True):
+	"""Fold message log rows into their conversations with one upsert
+	
+	Incoming messages add to the unread count. A conversation only takes a
+	message as its last message if it is newer than the current one, so
+	late or replayed deliveries do not rewind the thread.
+	"""
+	conversations = {}
+	now = frappe.utils.now()
+	user = frappe.session.user
+	
+	for msg_log in message_logs:
+		psid = get_conversation_psid(msg_log)
+		if not msg_log.get("facebook_account") or not psid:
+			continue
+		
+		name = get_conversation_name(msg_log["facebook_account"], psid)
+		message_at = msg_log.get("received_at") or msg_log.get("sent_at") or now
+		incoming = msg_log.get("direction") == "incoming"
+		
+		conversation = conversations.setdefault(name, {
+			"name": name, "creation": now, "modified": now, "owner": user, "modified_by": user,
+			"docstatus": 0, "idx": 0, "facebook_account": msg_log["facebook_account"], "psid": psid,
+			"sender_name": None, "last_message_at": None, "last_direction": None,
+			"unread_count": 0, "last_message_preview": None
+		})
+		if incoming:
+			conversation["sender_name"] = msg_log.get("sender_name") or conversation["sender_name"]
+			conversation["unread_count"] += 1 if count_unread else 0
+		if not conversation["last_message_at"] or str(message_at) >= str(conversation["last_message_at"]):
+			conversation.update({
+				"last_message_at": message_at,
+				"last_direction": msg_log.get("direction"),
+				"last_message_preview": get_message_preview(msg_log)
+			})
+	
+	if conversations:
+		upsert_conversations(list(conversations.values()))
+
+def upsert_conversations(rows):
+	columns = ", ".join(f"`{field}`" for field in CONVERSATION_FIELDS)
+	placeholders = ", ".join(["(" + ", ".join(["%s"] * len(CONVERSATION_FIELDS)) + ")"] * len(rows))
+	values = [row[field] for row in rows for field in CONVERSATION_FIELDS]
+	
+	if frappe.db.db_type == "postgres":
+		newer = "EXCLUDED.last_message_at >= COALESCE(tab.last_message_at, EXCLUDED.last_message_at)"
+		frappe.db.sql(f"""
+			INSERT INTO `tabFacebook Conversation` AS tab ({columns}) VALUES {placeholders}
+			ON CONFLICT (name) DO UPDATE SET
+				sender_name = COALESCE(EXCLUDED.sender_name, tab.sender_name),
+				unread_count = tab.unread_count + EXCLUDED.unread_count,
+				last_message_preview = CASE WHEN {newer} THEN EXCLUDED.last_message_preview ELSE tab.last_message_preview END,
+				last_direction = CASE WHEN {newer} THEN EXCLUDED.last_direction ELSE tab.last_direction END,
+				last_message_at = GREATEST(tab.last_message_at, EXCLUDED.last_message_at),
+				modified = EXCLUDED.modified
+		""", values)
+		return
+	
+	# MariaDB applies the assignments in order, so last_message_at goes last
+	newer = "VALUES(`last_message_at`) >= COALESCE(`last_message_at`, VALUES(`last_message_at`))"
+	frappe.db.sql(f"""
+		INSERT INTO `tabFacebook Conversation` ({columns}) VALUES {placeholders}
+		ON DUPLICATE KEY UPDATE
+			`sender_name` = COALESCE(VALUES(`sender_name`), `sender_name`),
+			`unread_count` = `unread_count` + VALUES(`unread_count`),
+			`last_message_preview` = IF({newer}, VALUES(`last_message_preview`), `last_message_preview`),
+			`last_direction` = IF({newer}, VALUES(`last_direction`), `last_direction`),
+			`last_message_at` = GREATEST(COALESCE(`last_message_at`, VALUES(`last_message_at`)), VALUES(`last_message_at`)),
+			`modified` = VALUES(`modified`)
+	""", values)
+
+@frappe.whitelist()
+def get_inbox(account_name=None, limit=20, cursor=None):
+	"""Get the conversations of an account, most recent activity first"""
+	try:
+		limit = get_page_size(limit, default=20)
+		filters, or_filters = get_keyset_filters(cursor, field="last_message_at")
+		if account_name:
+			filters.append(["facebook_account", "=", account_name])
+		
+		conversations = frappe.get_list("Facebook Conversation",
+			filters=filters,
+			or_filters=or_filters,
+			fields=CONVERSATION_LIST_FIELDS,
+			order_by="last_message_at desc, name desc",
+			limit=limit)
+		
+		return {
+			"success": True,
+			"conversations": conversations,
+			"next_cursor": get_next_cursor(conversations, limit, field="last_message_at")
+		}
+		
+	except Exception as e:
+		frappe.log_error(f"Get inbox failed: {str(e)}")
+		return {
+			"success": False,
+			"error": str(e)
+		}
+
+@frappe.whitelist()
+def mark_conversation_read(conversation):
+	"""Reset the unread count of a conversation"""
+	if not frappe.has_permission("Facebook Conversation", "write", conversation):
+		frappe.throw(_("Not permitted"), frappe.PermissionError)
+	frappe.db.set_value("Facebook Conversation", conversation, "unread_count", 0, update_modified=False)
+	return {"success": True}
+
+def get_conversation_rows(names):
+	names = list({name for name in names if name})
+	if not names:
+		return []
+	return frappe.get_all("Facebook Conversation",
+		filters={"name": ["in", names]},
+		fields=CONVERSATION_LIST_FIELDS)
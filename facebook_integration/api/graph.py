@@ -0,0 +1,376 @@
+import frappe
+import json
+import random
+import time
+import requests
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from facebook_integration.api.accounts import get_account_context
+
+GRAPH_URL = "https://graph.facebook.com"
+GRAPH_API_VERSION = "v18.0"
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_SLEEP = 30
+
+# Maximum number of sub-requests Graph accepts in one batch request
+BATCH_SIZE = 50
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# Graph error codes for throttling and temporary failures
+RETRY_ERROR_CODES = {1, 2, 4, 17, 32, 341, 613, 80000, 80001, 80002, 80003, 80004, 80005, 80006, 80008, 80014}
+
+# Methods that are safe to send again after a timeout or server error. Other
+# methods (POST) are only retried when the request never reached Graph.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "DELETE"}
+
+# Generic server-side Graph errors, after which a call may have been applied
+SERVER_ERROR_CODES = {1, 2}
+
+# Keep-alive sessions kept in this worker process, one per site and account
+_sessions = {}
+
+# Rate limit pacing. Usage reported in the X-*-Usage headers is stored in
+# Redis per app (X-App-Usage) and per account (page, ad account and business
+# use case headers); calls are slowed down once the highest reported
+# utilisation passes the target (percent, `facebook_graph_usage_target` site
+# config key) and held back while Graph reports a lockout.
+DEFAULT_USAGE_TARGET = 75
+USAGE_TTL = 15 * 60
+PACE_SLEEP_PER_PERCENT = 0.2
+MAX_PACE_SLEEP = 10
+MAX_LOCKOUT_WAIT = 60
+
+USAGE_HEADERS = {
+	"app": ("X-App-Usage",),
+	"account": ("X-Page-Usage", "X-Ad-Account-Usage", "X-Business-Use-Case-Usage")
+}
+
+# Stores the latest utilisation of a scope, keeping the later of the stored
+# and reported lockout so concurrent responses never shorten it
+RECORD_USAGE_SCRIPT = """
+local blocked_until = tonumber(ARGV[2])
+local current = redis.call('GET', KEYS[1])
+if current then
+	blocked_until = math.max(blocked_until, tonumber(cjson.decode(current)['blocked_until']) or 0)
+end
+local ttl = math.max(tonumber(ARGV[3]), math.ceil(blocked_until - tonumber(ARGV[4])))
+redis.call('SET', KEYS[1], cjson.encode({utilisation = tonumber(ARGV[1]), blocked_until = blocked_until}), 'EX', ttl)
+"""
+
+class GraphAPIError(frappe.ValidationError):
+	def __init__(self, data):
+		self.data = data
+		error = data.get("error", {}) if isinstance(data, dict) else {}
+		super().__init__(error.get("message") or str(data))
+
+class GraphRateLimitError(GraphAPIError):
+	def __init__(self, retry_after):
+		self.retry_after = retry_after
+		super().__init__({"error": {
+			"message": f"Graph API rate limit reached, access regained in {int(retry_after)} seconds",
+			"code": 4
+		}})
+
+class GraphClient:
+	"""Graph API client with pooled keep-alive sessions, timeouts and retries
+
+	Responses are returned as parsed JSON. Graph errors are returned the way
+	the API reports them (a dict with an "error" key) once retries are spent.
+	"""
+
+	def __init__(self, access_token, account=None, app_id=None):
+		self.access_token = access_token
+		self.account = account
+		self.usage_scopes = [scope for scope in (app_id and f"app:{app_id}", account and f"account:{account}") if scope]
+		self.version = frappe.conf.get("facebook_graph_api_version") or GRAPH_API_VERSION
+		timeout = frappe.conf.get("facebook_graph_timeout") or DEFAULT_TIMEOUT
+		self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+		self.max_retries = frappe.utils.cint(frappe.conf.get("facebook_graph_max_retries", DEFAULT_MAX_RETRIES))
+		self.session = get_session(account)
+
+	def url(self, path):
+		if str(path).startswith(GRAPH_URL):
+			# Absolute paging URLs already carry the version
+			return path
+		return f"{GRAPH_URL}/{self.version}/{str(path).lstrip('/')}"
+
+	def get(self, path, params=None):
+		return self.request("GET", path, params=params)
+
+	def post(self, path, data=None, json=None, params=None):
+		return self.request("POST", path, params=params, data=data, json=json)
+
+	def delete(self, path, params=None):
+		return self.request("DELETE", path, params=params)
+
+	def request(self, method, path, params=None, data=None, json=None, idempotent=None):
+		"""Send a request, retrying it as far as is safe for the method
+		
+		`idempotent` overrides the method's default, e.g. for a batch POST
+		carrying only GET sub-requests.
+		"""
+		params = dict(params or {})
+		if "access_token=" not in str(path):
+			params["access_token"] = self.access_token
+
+		if idempotent is None:
+			idempotent = method.upper() in IDEMPOTENT_METHODS
+		for attempt in range(self.max_retries + 1):
+			last_attempt = attempt == self.max_retries
+			throttle(self.usage_scopes)
+			try:
+				response = self.session.request(method, self.url(path),
+					params=params, data=data, json=json, timeout=self.timeout)
+			except (requests.ConnectionError, requests.Timeout) as e:
+				if last_attempt or not (idempotent or is_connect_error(e)):
+					raise
+				sleep_before_retry(attempt)
+				continue
+			
+			record_usage(self.usage_scopes, response.headers)
+
+			if not last_attempt and is_retryable(response, idempotent):
+				sleep_before_retry(attempt)
+				continue
+
+			return parse_response(response)
+
+	def paginate(self, path, params=None, with_cursor=False):
+		"""Yield the objects of an edge one page at a time, following cursors
+		
+		Only one page is held in memory. With `with_cursor`, yields
+		(objects, after) so callers can checkpoint and later resume with
+		params={"after": after}. Raises GraphAPIError if a page fails.
+		"""
+		params = dict(params or {})
+		while True:
+			data = self.get(path, params=params)
+			if "error" in data:
+				raise GraphAPIError(data)
+			
+			paging = data.get("paging", {})
+			after = paging.get("cursors", {}).get("after")
+			
+			yield (data.get("data", []), after) if with_cursor else data.get("data", [])
+			
+			if not paging.get("next"):
+				return
+			
+			if after:
+				params["after"] = after
+			else:
+				# Edges without cursors only expose the next page URL
+				path, params = paging["next"], {}
+
+	def batch(self, calls):
+		"""Run many calls through the Graph Batch API, 50 sub-requests per round-trip
+		
+		`calls` is a list of dicts with `path` and optional `method`, `params`
+		and `data`. Returns one parsed body per call, in order. Failed
+		sub-requests yield an error dict; retryable ones are re-batched, as
+		are chunks whose whole batch request failed with a retryable error.
+		Chunks of GET calls only are retried like GET requests.
+		"""
+		results = [None] * len(calls)
+		pending = list(range(len(calls)))
+
+		for attempt in range(self.max_retries + 1):
+			retry = []
+			for start in range(0, len(pending), BATCH_SIZE):
+				chunk = pending[start:start + BATCH_SIZE]
+				idempotent = all(str(calls[i].get("method", "GET")).upper() in IDEMPOTENT_METHODS for i in chunk)
+				response = self.request("POST", "", data={
+					"batch": json.dumps([get_batch_item(calls[i]) for i in chunk]),
+					"include_headers": "false"
+				}, idempotent=idempotent)
+
+				if not isinstance(response, list):
+					# The whole batch request failed
+					for i in chunk:
+						results[i] = response
+					if is_retryable_error(response, idempotent):
+						retry.extend(chunk)
+					continue
+
+				for i, item in zip(chunk, response):
+					results[i] = parse_batch_item(item)
+					if is_retryable_batch_item(item, idempotent):
+						retry.append(i)
+
+			if not retry or attempt == self.max_retries:
+				break
+			sleep_before_retry(attempt)
+			pending = retry
+
+		return results
+
+def get_graph_client(account):
+	"""Return a GraphClient for a Facebook Account name or context"""
+	account = get_account_context(account)
+	return GraphClient(account.access_token, account=account.name, app_id=account.app_id)
+
+def get_session(account=None):
+	key = (frappe.local.site, account)
+	session = _sessions.get(key)
+	if not session:
+		session = requests.Session()
+		session.headers.update({"Accept-Encoding": "gzip, deflate"})
+		adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+		session.mount("https://", adapter)
+		_sessions[key] = session
+	return session
+
+def parse_response(response):
+	try:
+		return response.json()
+	except ValueError:
+		return {"error": {"message": response.text or response.reason, "code": response.status_code}}
+
+def get_batch_item(call):
+	method = call.get("method", "GET")
+	relative_url = str(call["path"]).lstrip("/")
+	if call.get("params"):
+		relative_url += "?" + urlencode(call["params"])
+
+	item = {"method": method, "relative_url": relative_url}
+	if call.get("data"):
+		item["body"] = urlencode(call["data"])
+	return item
+
+def parse_batch_item(item):
+	if item is None:
+		# Graph returns null for sub-requests it could not complete in time
+		return {"error": {"message": "Batch sub-request did not complete", "code": 2}}
+	try:
+		body = json.loads(item.get("body") or "null")
+	except ValueError:
+		body = None
+	if not isinstance(body, dict) or (item.get("code", 200) >= 400 and "error" not in body):
+		return {"error": {"message": item.get("body") or "Empty response", "code": item.get("code")}}
+	return body
+
+def is_retryable_batch_item(item, idempotent=True):
+	if item is None or item.get("code", 200) >= 500:
+		return idempotent
+	return get_error_code(parse_batch_item(item)) in RETRY_ERROR_CODES
+
+def is_retryable_error(data, idempotent=True):
+	"""True if a parsed Graph error is worth retrying"""
+	code = get_error_code(data)
+	if code in SERVER_ERROR_CODES or frappe.utils.cint(code) >= 500:
+		return idempotent
+	return code == 429 or code in RETRY_ERROR_CODES
+
+def get_error_code(data):
+	if isinstance(data, dict) and isinstance(data.get("error"), dict):
+		return data["error"].get("code")
+
+def is_connect_error(error):
+	"""True if the request failed before it was sent, so Graph never saw it"""
+	if isinstance(error, requests.ConnectTimeout):
+		return True
+	reason = getattr(error.args[0], "reason", None) if error.args else None
+	return isinstance(reason, NewConnectionError)
+
+def is_retryable(response, idempotent=True):
+	if response.status_code >= 500:
+		# The call may have been applied before the server failed
+		return idempotent
+	if response.status_code == 429:
+		return True
+	if response.status_code >= 400:
+		return get_error_code(parse_response(response)) in RETRY_ERROR_CODES
+	return False
+
+def sleep_before_retry(attempt):
+	"""Exponential backoff with full jitter"""
+	time.sleep(random.uniform(0, min(MAX_RETRY_SLEEP, RETRY_BACKOFF * 2 ** attempt)))
+
+def get_usage_key(scope):
+	return frappe.cache().make_key(f"facebook_graph_usage|{scope}")
+
+def parse_usage_headers(headers, names):
+	"""Return (highest utilisation percent, seconds until access is regained)"""
+	utilisation = 0
+	regain_after = 0
+
+	for header in names:
+		value = headers.get(header)
+		if not value:
+			continue
+		try:
+			usage = json.loads(value)
+		except ValueError:
+			continue
+
+		if header == "X-Business-Use-Case-Usage":
+			entries = [entry for business in usage.values() for entry in business]
+		else:
+			entries = [usage]
+
+		for entry in entries:
+			utilisation = max(utilisation,
+				frappe.utils.flt(entry.get("call_count")),
+				frappe.utils.flt(entry.get("total_time")),
+				frappe.utils.flt(entry.get("total_cputime")),
+				frappe.utils.flt(entry.get("acc_id_util_pct")))
+			# Graph reports the lockout in minutes
+			regain_after = max(regain_after, frappe.utils.flt(entry.get("estimated_time_to_regain_access")) * 60)
+
+	return utilisation, regain_after
+
+def record_usage(scopes, headers):
+	"""Store the usage reported for each scope from the headers that apply to it"""
+	now = time.time()
+	pipe = None
+	for scope in scopes:
+		names = USAGE_HEADERS[scope.split(":", 1)[0]]
+		if not any(headers.get(header) for header in names):
+			continue
+
+		utilisation, regain_after = parse_usage_headers(headers, names)
+		pipe = pipe or frappe.cache().pipeline()
+		pipe.eval(RECORD_USAGE_SCRIPT, 1, get_usage_key(scope),
+			utilisation, now + regain_after if regain_after else 0, USAGE_TTL, now)
+
+	if pipe:
+		pipe.execute()
+
+def get_usage(scopes):
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	for scope in scopes:
+		pipe.get(get_usage_key(scope))
+	return [json.loads(value) for value in pipe.execute() if value]
+
+def throttle(scopes):
+	"""Wait as needed to keep Graph usage under the target
+
+	Raises GraphRateLimitError when Graph reports a lockout longer than a
+	worker should sleep.
+	"""
+	if not scopes:
+		return
+
+	usages = get_usage(scopes)
+	if not usages:
+		return
+
+	blocked_for = max(usage.get("blocked_until", 0) for usage in usages) - time.time()
+	if blocked_for > MAX_LOCKOUT_WAIT:
+		raise GraphRateLimitError(blocked_for)
+	if blocked_for > 0:
+		time.sleep(blocked_for)
+		return
+
+	target = frappe.utils.flt(frappe.conf.get("facebook_graph_usage_target")) or DEFAULT_USAGE_TARGET
+	over_target = max(usage.get("utilisation", 0) for usage in usages) - target
+	if over_target > 0:
+		time.sleep(min(MAX_PACE_SLEEP, over_target * PACE_SLEEP_PER_PERCENT))
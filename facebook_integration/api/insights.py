@@ -1,74 +1,78 @@
 import frappe
-import requests
 from frappe import _
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.api.graph import GraphAPIError, get_graph_client
 from datetime import datetime, timedelta
 
 @frappe.whitelist()
 def sync_campaign_insights(account_name, days_back=7):
 	"""Sync Facebook Ads campaign insights"""
-	account = frappe.get_doc("Facebook Account", account_name)
+	account = get_account_context(account_name)
 	if not account.enable_ads or not account.ad_account_id:
 		return {"status": "error", "message": "Ads integration not enabled or Ad Account ID missing"}
 	
 	try:
 		# Get campaigns
-		campaigns_url = f"https://graph.facebook.com/v18.0/act_{account.ad_account_id}/campaigns"
-		campaigns_params = {
-			"access_token": account.get_password("access_token"),
-			"fields": "id,name,status,objective",
-			"limit": 100
-		}
-		
-		campaigns_response = requests.get(campaigns_url, params=campaigns_params)
-		campaigns_data = campaigns_response.json()
-		
-		if "error" in campaigns_data:
-			return {"status": "error", "message": campaigns_data["error"]["message"]}
+		client = get_graph_client(account)
 		
 		synced_count = 0
-		for campaign in campaigns_data.get("data", []):
-			# Get insights for each campaign
-			insights = get_campaign_insights(account, campaign["id"], days_back)
-			if insights:
-				save_campaign_metrics(account_name, campaign, insights)
-				synced_count += 1
+		for campaigns in client.paginate(f"act_{account.ad_account_id}/campaigns", params={
+			"fields": "id,name,status,objective",
+			"limit": 100
+		}):
+			# Get insights for the page of campaigns through batched requests
+			campaign_insights = get_campaigns_insights(account,
+				[campaign["id"] for campaign in campaigns], days_back, client=client)
+			
+			for campaign in campaigns:
+				insights = campaign_insights.get(campaign["id"])
+				if insights:
+					save_campaign_metrics(account_name, campaign, insights)
+					synced_count += 1
 		
 		# Update last synced
-		account.last_synced = frappe.utils.now()
-		account.save()
+		frappe.db.set_value("Facebook Account", account_name, "last_synced", frappe.utils.now())
 		
 		return {"status": "success", "synced": synced_count}
 		
+	except GraphAPIError as e:
+		return {"status": "error", "message": str(e)}
 	except Exception as e:
 		frappe.log_error(f"Campaign insights sync error: {str(e)}")
 		return {"status": "error", "message": str(e)}
 
-def get_campaign_insights(account, campaign_id, days_back):
-	"""Get insights for a specific campaign"""
-	try:
-		since_date = (datetime.now() - timedelta(days=days_back)).strftime("%Y-%m-%d")
-		until_date = datetime.now().strftime("%Y-%m-%d")
-		
-		url = f"https://graph.facebook.com/v18.0/{campaign_id}/insights"
-		params = {
-			"access_token": account.get_password("access_token"),
-			"fields": "spend,impressions,clicks,ctr,cpc,cpm,reach,frequency,actions",
-			"time_range": f"{{'since':'{since_date}','until':'{until_date}'}}",
-			"time_increment": 1
-		}
-		
-		response = requests.get(url, params=params)
-		data = response.json()
-		
+def get_campaigns_insights(account, campaign_ids, days_back, client=None):
+	"""Get insights for many campaigns, 50 campaigns per Graph batch request
+	
+	Returns a dict of campaign id to insight rows. Campaigns whose
+	sub-request failed are logged and left out.
+	"""
+	client = client or get_graph_client(account)
+	params = get_insights_params(days_back)
+	
+	results = client.batch([
+		{"path": f"{campaign_id}/insights", "params": params}
+		for campaign_id in campaign_ids
+	])
+	
+	insights = {}
+	for campaign_id, data in zip(campaign_ids, results):
 		if "error" in data:
-			frappe.log_error(f"Campaign insights API error: {data['error']['message']}")
-			return None
-		
-		return data.get("data", [])
-		
-	except Exception as e:
-		frappe.log_error(f"Get campaign insights error: {str(e)}")
-		return None
+			frappe.log_error(f"Campaign insights API error for {campaign_id}: {data['error'].get('message')}")
+			continue
+		insights[campaign_id] = data.get("data", [])
+	
+	return insights
+
+def get_insights_params(days_back):
+	since_date = (datetime.now() - timedelta(days=frappe.utils.cint(days_back))).strftime("%Y-%m-%d")
+	until_date = datetime.now().strftime("%Y-%m-%d")
+	
+	return {
+		"fields": "spend,impressions,clicks,ctr,cpc,cpm,reach,frequency,actions",
+		"time_range": f"{{'since':'{since_date}','until':'{until_date}'}}",
+		"time_increment": 1
+	}
 
 def save_campaign_metrics(account_name, campaign, insights_data):
 	"""Save campaign metrics to ERPNext"""
@@ -0,0 +1,148 @@
+import frappe
+import time
+from concurrent.futures import as_completed
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.api.graph import get_graph_client
+from facebook_integration.api.leads import ingest_leads
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import SiteThreadPool, account_lease
+
+# Historical lead backfill
+# ------------------------
+# Walks every lead of every form of an account, several forms at a time.
+# Each page is ingested and committed together with the form's paging
+# cursor, so a crashed or stopped backfill resumes after the last committed
+# page. Forms already Completed are skipped unless the backfill is
+# restarted. Backfilled leads do not create ERPNext documents; map them in
+# bulk with leads.map_leads().
+
+BACKFILL_PAGE_SIZE = 100
+DEFAULT_BACKFILL_CONCURRENCY = 4
+BACKFILL_TIMEOUT = 12 * 60 * 60
+
+def get_backfill_concurrency():
+	"""Forms backfilled at the same time, `facebook_lead_backfill_concurrency` site config key"""
+	return frappe.utils.cint(frappe.conf.get("facebook_lead_backfill_concurrency")) or DEFAULT_BACKFILL_CONCURRENCY
+
+@frappe.whitelist()
+def start_lead_backfill(account_name, restart=0):
+	"""Enqueue the Lead Ads history backfill of an account"""
+	frappe.only_for("System Manager")
+	if not get_account_context(account_name).enable_leads:
+		return {"status": "error", "message": "Lead Ads not enabled"}
+	
+	enqueue_event_job("sync", "facebook_integration.api.lead_backfill.backfill_leads",
+		account_name=account_name,
+		restart=frappe.utils.cint(restart),
+		job_id=f"facebook_lead_backfill|{account_name}",
+		deduplicate=True,
+		timeout=BACKFILL_TIMEOUT)
+	return {"status": "success"}
+
+@frappe.whitelist()
+def get_backfill_status(account_name):
+	"""Return the backfill progress of every form of an account"""
+	forms = frappe.get_list("Facebook Lead Form",
+		filters={"facebook_account": account_name},
+		fields=["form_id", "form_name", "backfill_status", "backfill_leads", "backfill_updated_at", "backfill_error"],
+		order_by="form_id asc")
+	return {"status": "success", "forms": forms, "leads": sum(form.backfill_leads or 0 for form in forms)}
+
+def backfill_leads(account_name, restart=False):
+	"""Backfill the leads of every form of an account, resuming from checkpoints"""
+	with account_lease("lead_backfill", account_name) as acquired:
+		if not acquired:
+			return {"status": "skipped", "message": "Backfill already running"}
+		
+		started = time.monotonic()
+		form_ids = prepare_backfill_forms(account_name, restart)
+		frappe.db.commit()
+		
+		results = {}
+		if form_ids:
+			with SiteThreadPool(max_workers=min(get_backfill_concurrency(), len(form_ids))) as pool:
+				futures = {
+					pool.submit(run_form_backfill, account_name, form_id): form_id
+					for form_id in form_ids
+				}
+				for future in as_completed(futures):
+					results[futures[future]] = future.result()
+		
+		report = {
+			"status": "success" if all(result["status"] == "success" for result in results.values()) else "error",
+			"forms": len(form_ids),
+			"leads": sum(result.get("leads", 0) for result in results.values()),
+			"wall_clock": round(time.monotonic() - started, 3),
+			"results": results
+		}
+		frappe.logger("facebook_integration").info({"task": "lead_backfill", "account": account_name, **report})
+		return report
+
+def prepare_backfill_forms(account_name, restart=False):
+	"""Register every lead form of the account and return the ones left to backfill"""
+	client = get_graph_client(account_name)
+	account = get_account_context(account_name)
+	known = {
+		form.form_id: form
+		for form in frappe.get_all("Facebook Lead Form",
+			filters={"facebook_account": account_name},
+			fields=["form_id", "backfill_status"])
+	}
+	
+	pending = []
+	for forms in client.paginate(f"{account.page_id}/leadgen_forms", params={"fields": "id,name", "limit": 100}):
+		for form in forms:
+			if form["id"] not in known:
+				lead_form = frappe.new_doc("Facebook Lead Form")
+				lead_form.facebook_account = account_name
+				lead_form.form_id = form["id"]
+				lead_form.form_name = form.get("name")
+				lead_form.insert(ignore_permissions=True)
+			elif known[form["id"]].backfill_status == "Completed" and not restart:
+				continue
+			
+			values = {"backfill_status": "Pending", "backfill_error": None}
+			if restart:
+				values.update({"backfill_cursor": None, "backfill_leads": 0})
+			frappe.db.set_value("Facebook Lead Form", form["id"], values, update_modified=False)
+			pending.append(form["id"])
+	
+	return pending
+
+def run_form_backfill(account_name, form_id):
+	"""Backfill one form in its own transaction on a SiteThreadPool worker"""
+	try:
+		return backfill_form(account_name, form_id)
+	except Exception as e:
+		frappe.db.rollback()
+		set_backfill_state(form_id, backfill_status="Failed", backfill_error=str(e))
+		frappe.db.commit()
+		frappe.log_error(f"Lead backfill failed for form {form_id}: {str(e)}")
+		return {"status": "failed", "error": str(e)}
+
+def backfill_form(account_name, form_id):
+	"""Page through all leads of a form, committing each page with its cursor"""
+	state = frappe.db.get_value("Facebook Lead Form", form_id, ["backfill_cursor", "backfill_leads"], as_dict=True)
+	params = {"fields": "id,created_time,field_data", "limit": BACKFILL_PAGE_SIZE}
+	if state.backfill_cursor:
+		params["after"] = state.backfill_cursor
+	
+	count = state.backfill_leads or 0
+	set_backfill_state(form_id, backfill_status="Running")
+	frappe.db.commit()
+	
+	client = get_graph_client(account_name)
+	for leads, after in client.paginate(f"{form_id}/leads", params=params, with_cursor=True):
+		ingest_leads(account_name, leads, form_id=form_id, create_documents=False, remember=False)
+		count += len(leads)
+		set_backfill_state(form_id, backfill_cursor=after or state.backfill_cursor, backfill_leads=count)
+		frappe.db.commit()
+	
+	set_backfill_state(form_id, backfill_status="Completed", backfill_cursor=None)
+	frappe.db.commit()
+	return {"status": "success", "leads": count}
+
+def set_backfill_state(form_id, **values):
+	frappe.db.set_value("Facebook Lead Form", form_id,
+		{**values, "backfill_updated_at": frappe.utils.now()},
+		update_modified=False)
@@ -0,0 +1,89 @@
+import frappe
+import re
+
+# Per-form field mapping
+# ----------------------
+# Each Facebook Lead Form can map Lead Ads question keys to Facebook Lead Log
+# fields and to fields of the ERPNext Lead. Mappings are compiled once per
+# form into {question key: [(transform, lead log field, lead field)]} and
+# cached in Redis; saving a changed mapping drops the compiled copy.
+
+FORM_MAPPING_KEY = "facebook_lead_form_mapping"
+
+# Used for forms without mapping rows
+DEFAULT_FIELD_MAPPING = [
+	("email", "email", None, "Strip"),
+	("phone_number", "phone", None, "Strip"),
+	("full_name", "full_name", None, "Strip"),
+	("company_name", "company_name", None, "Strip"),
+]
+
+def format_phone(value):
+	"""Keep the digits and a leading plus sign of a phone number to store
+	
+	Duplicate matching compares contacts.normalize_phone keys instead.
+	"""
+	value = value.strip()
+	digits = re.sub(r"\D", "", value)
+	return f"+{digits}" if value.startswith("+") else digits
+
+TRANSFORMS = {
+	"Strip": lambda value: value.strip(),
+	"Lowercase": lambda value: value.strip().lower(),
+	"Title Case": lambda value: value.strip().title(),
+	"Normalize Phone": format_phone,
+	"First Name": lambda value: value.strip().split(" ", 1)[0],
+	"Last Name": lambda value: (value.strip().split(" ", 1)[1:] or [""])[0].strip(),
+}
+
+def get_mapping_rows(lead_form):
+	"""Return the mapping rows of a Facebook Lead Form as plain tuples"""
+	return [
+		(row.question_key, row.lead_log_field or None, row.lead_field or None, row.transform or None)
+		for row in lead_form.get("field_mappings") or []
+		if row.question_key and (row.lead_log_field or row.lead_field)
+	]
+
+def compile_form_mapping(form_id):
+	rows = None
+	if form_id and frappe.db.exists("Facebook Lead Form", form_id):
+		rows = get_mapping_rows(frappe.get_doc("Facebook Lead Form", form_id))
+	
+	mapping = {}
+	for question_key, lead_log_field, lead_field, transform in rows or DEFAULT_FIELD_MAPPING:
+		mapping.setdefault(question_key, []).append((transform, lead_log_field, lead_field))
+	return mapping
+
+def get_form_mapping(form_id):
+	"""Return the compiled field mapping of a lead form"""
+	return frappe.cache().hget(FORM_MAPPING_KEY, form_id or "",
+		generator=lambda: compile_form_mapping(form_id))
+
+def clear_form_mapping_cache(form_id):
+	frappe.cache().hdel(FORM_MAPPING_KEY, form_id)
+
+def apply_form_mapping(mapping, field_data):
+	"""Map the answers of one lead
+	
+	Returns (lead log values, ERPNext Lead values). The first answer of each
+	question is used; questions without a mapping are ignored.
+	"""
+	log_values = {}
+	lead_values = {}
+	
+	for field in field_data or []:
+		targets = mapping.get(field.get("name"))
+		values = field.get("values")
+		if not targets or not values or values[0] is None:
+			continue
+		
+		for transform, lead_log_field, lead_field in targets:
+			value = str(values[0])
+			if transform:
+				value = TRANSFORMS[transform](value)
+			if lead_log_field:
+				log_values[lead_log_field] = value
+			if lead_field:
+				lead_values[lead_field] = value
+	
+	return log_values, lead_values
@@ -1,41 +1,136 @@
 import frappe
 import json
-import requests
+from datetime import datetime, timezone
 from frappe import _
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.api.contacts import get_match_keys, match_documents
+from facebook_integration.api.graph import GraphAPIError, get_graph_client
+from facebook_integration.api.lead_mapping import apply_form_mapping, get_form_mapping
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import bulk_insert_docs, filter_unseen, get_keyset_filters, get_next_cursor, get_page_size, mark_seen, mark_seen_after_commit
+
+# Lead logs converted per transaction by the bulk mapping job
+MAP_CHUNK_SIZE = 100
+
+# Columns returned by the lead list APIs
+LEAD_LIST_FIELDS = [
+	"name", "creation", "facebook_account", "fb_leadgen_id", "form_id", "created_at",
+	"full_name", "email", "phone", "company_name",
+]
+
+LEAD_MAPPING_FIELDS = ["name", "facebook_account", "full_name", "email", "phone", "company_name", "lead_values"]
 
 @frappe.whitelist()
-def fetch_leads(account_name, limit=50):
-	"""Fetch leads from Facebook Lead Ads"""
-	account = frappe.get_doc("Facebook Account", account_name)
+def fetch_leads(account_name, limit=50, full_resync=0):
+	"""Fetch leads from Facebook Lead Ads
+	
+	Each form keeps a checkpoint in Facebook Lead Form; polling only asks
+	Graph for leads created after it. `full_resync` ignores the checkpoints
+	and walks every lead of every form.
+	"""
+	account = get_account_context(account_name)
 	if not account.enable_leads:
 		return {"status": "error", "message": "Lead Ads not enabled"}
 	
 	try:
-		url = f"https://graph.facebook.com/v18.0/{account.page_id}/leadgen_forms"
-		params = {
-			"access_token": account.get_password("access_token"),
-			"fields": "id,name,leads{id,created_time,field_data}",
-			"limit": limit
-		}
-		
-		response = requests.get(url, params=params)
-		data = response.json()
-		
-		if "error" in data:
-			return {"status": "error", "message": data["error"]["message"]}
+		client = get_graph_client(account)
+		checkpoints = get_form_checkpoints(account_name)
 		
 		processed_count = 0
-		for form in data.get("data", []):
-			for lead in form.get("leads", {}).get("data", []):
-				process_facebook_lead(account_name, lead)
-				processed_count += 1
+		for forms in client.paginate(f"{account.page_id}/leadgen_forms", params={
+			"fields": "id,name",
+			"limit": limit
+		}):
+			for form in forms:
+				processed_count += poll_form_leads(client, account_name, form,
+					checkpoints.get(form["id"]), limit, frappe.utils.cint(full_resync))
 		
 		return {"status": "success", "processed": processed_count}
 		
+	except GraphAPIError as e:
+		return {"status": "error", "message": str(e)}
 	except Exception as e:
 		frappe.log_error(f"Lead fetch error: {str(e)}")
 		return {"status": "error", "message": str(e)}
 
+def poll_form_leads(client, account_name, form, checkpoint, limit, full_resync=False):
+	"""Fetch the leads of one form created since its checkpoint and advance it
+	
+	The checkpoint second is fetched again, since Graph filters on whole
+	seconds; leads already stored are dropped as duplicates on ingest.
+	"""
+	params = {"fields": "id,created_time,field_data", "limit": limit}
+	watermark = checkpoint.last_created_time if checkpoint and not full_resync else None
+	if watermark:
+		params["filtering"] = json.dumps([{
+			"field": "time_created",
+			"operator": "GREATER_THAN_OR_EQUAL",
+			"value": int(watermark.replace(tzinfo=timezone.utc).timestamp())
+		}])
+	
+	newest = watermark
+	cursor = None
+	processed_count = 0
+	
+	for leads, after in client.paginate(f"{form['id']}/leads", params=params, with_cursor=True):
+		new_leads = len(ingest_leads(account_name, leads, form_id=form["id"]))
+		processed_count += len(leads)
+		
+		for lead in leads:
+			created = parse_graph_time(lead.get("created_time"))
+			if created and (not newest or created > newest):
+				newest = created
+		
+		cursor = after or cursor
+		
+		# Without a checkpoint, leads come newest first: stop at the first page with nothing new
+		if not watermark and not full_resync and not new_leads:
+			break
+	
+	save_form_checkpoint(account_name, form, newest, cursor)
+	return processed_count
+
+def get_form_checkpoints(account_name):
+	return {
+		form.form_id: form
+		for form in frappe.get_all("Facebook Lead Form",
+			filters={"facebook_account": account_name},
+			fields=["form_id", "last_created_time", "last_cursor"])
+	}
+
+def save_form_checkpoint(account_name, form, last_created_time, last_cursor=None):
+	"""Write the poll checkpoint columns of a form
+	
+	Only these columns are set, so a running backfill's progress on the
+	same form is never overwritten with stale values.
+	"""
+	values = {"last_polled_at": frappe.utils.now()}
+	if form.get("name"):
+		values["form_name"] = form["name"]
+	if last_created_time:
+		values["last_created_time"] = last_created_time
+	if last_cursor:
+		values["last_cursor"] = last_cursor
+	
+	if frappe.db.exists("Facebook Lead Form", form["id"]):
+		frappe.db.set_value("Facebook Lead Form", form["id"], values)
+		return
+	
+	lead_form = frappe.new_doc("Facebook Lead Form")
+	lead_form.form_id = form["id"]
+	lead_form.facebook_account = account_name
+	lead_form.update(values)
+	lead_form.insert(ignore_permissions=True)
+
+def parse_graph_time(value):
+	"""Convert a Graph timestamp such as 2024-01-31T10:00:00+0000 to naive UTC"""
+	if not value:
+		return None
+	try:
+		return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").astimezone(timezone.utc).replace(tzinfo=None)
+	except ValueError:
+		return None
+
 @frappe.whitelist()
 def map_lead(lead_log_name, doctype="Lead"):
 	"""Map Facebook lead to ERPNext Lead/Contact/Customer"""
@@ -48,140 +143,495 @@ def map_lead(lead_log_name, doctype="Lead"):
 	elif doctype == "Customer":
 		return create_erp_customer(lead_log)
 
-def process_facebook_lead(account_name, lead_data):
+@frappe.whitelist()
+def map_leads(doctype="Lead", lead_logs=None, filters=None):
+	"""Map many Facebook leads to ERPNext Leads/Contacts/Customers in the background
+	
+	Takes a list of Facebook Lead Log names or a filter. Lead logs already
+	linked to a document of the target doctype are skipped. Progress is
+	published on the `facebook_lead_mapping` realtime event.
+	"""
+	if doctype not in MAP_TARGETS:
+		frappe.throw(_("Facebook leads can only be mapped to {0}").format(", ".join(MAP_TARGETS)))
+	
+	link_field = MAP_TARGETS[doctype][0]
+	filters = frappe.parse_json(filters)
+	lead_logs = frappe.parse_json(lead_logs)
+	if lead_logs:
+		filters = {"name": ["in", lead_logs]}
+	
+	# The desk list view sends filters as a list of lists
+	if isinstance(filters, (list, tuple)):
+		filters = [*filters, [link_field, "is", "not set"]]
+	else:
+		filters = {**(filters or {}), link_field: ["is", "not set"]}
+	
+	names = frappe.get_list("Facebook Lead Log", filters=filters, pluck="name", limit_page_length=0)
+	if not names:
+		return {"success": True, "total": 0}
+	
+	task_id = frappe.generate_hash(length=10)
+	enqueue_event_job("sync", "facebook_integration.api.leads.map_leads_job",
+		doctype=doctype,
+		lead_logs=names,
+		task_id=task_id,
+		user=frappe.session.user,
+		timeout=3600)
+	
+	return {"success": True, "total": len(names), "task_id": task_id}
+
+def map_leads_job(doctype, lead_logs, task_id=None, user=None, chunk_size=MAP_CHUNK_SIZE):
+	"""Map lead logs in chunks, committing and reporting progress after each chunk"""
+	mapped = 0
+	failed = []
+	
+	for start in range(0, len(lead_logs), chunk_size):
+		rows = frappe.get_all("Facebook Lead Log",
+			filters={"name": ["in", lead_logs[start:start + chunk_size]], MAP_TARGETS[doctype][0]: ["is", "not set"]},
+			fields=LEAD_MAPPING_FIELDS)
+		
+		chunk_mapped, chunk_failed = create_erp_docs(doctype, rows)
+		frappe.db.commit()
+		
+		mapped += chunk_mapped
+		failed += chunk_failed
+		publish_mapping_progress(task_id, user, doctype, len(lead_logs),
+			min(start + chunk_size, len(lead_logs)), mapped, failed)
+	
+	return {"mapped": mapped, "failed": failed}
+
+def publish_mapping_progress(task_id, user, doctype, total, processed, mapped, failed):
+	frappe.publish_realtime("facebook_lead_mapping", {
+		"task_id": task_id,
+		"doctype": doctype,
+		"total": total,
+		"processed": processed,
+		"mapped": mapped,
+		"failed": len(failed),
+		"done": processed >= total
+	}, user=user)
+
+def process_facebook_lead(account_name, lead_data, form_id=None):
 	"""Process single Facebook lead"""
-	fb_lead_id = lead_data.get("id")
+	lead_logs = ingest_leads(account_name, [lead_data], form_id=form_id)
+	return lead_logs[0] if lead_logs else None
+
+def ingest_leads(account_name, leads, form_id=None, create_documents=True, remember=True):
+	"""Store a page of Facebook leads with set-based dedup and one bulk insert
 	
+	Already known leadgen ids are resolved with the idempotency filter and a
+	single IN query; only new Facebook Lead Log rows are inserted. Returns
+	the inserted rows. Historical imports pass `create_documents=False` to
+	leave ERPNext mapping to map_leads(), and `remember=False` to keep their
+	ids out of the idempotency filter.
+	"""
 	# Check if already processed
-	if frappe.db.exists("Facebook Lead Log", {"fb_leadgen_id": fb_lead_id}):
-		return
+	lead_ids = list(dict.fromkeys(filter_unseen("lead", [lead.get("id") for lead in leads])))
+	if not lead_ids:
+		return []
+	
+	existing = set(frappe.get_all("Facebook Lead Log",
+		filters={"fb_leadgen_id": ["in", lead_ids]},
+		pluck="fb_leadgen_id"))
+	mark_seen("lead", existing)
 	
-	# Create lead log
-	lead_log = frappe.new_doc("Facebook Lead Log")
-	lead_log.facebook_account = account_name
-	lead_log.fb_leadgen_id = fb_lead_id
-	lead_log.created_at = lead_data.get("created_time")
-	lead_log.data = frappe.as_json(lead_data)
+	new_ids = set(lead_ids) - existing
+	mappings = {}
+	rows = []
+	for lead_data in leads:
+		if lead_data.get("id") in new_ids:
+			new_ids.discard(lead_data.get("id"))
+			lead_form = form_id or lead_data.get("form_id")
+			if lead_form not in mappings:
+				mappings[lead_form] = get_form_mapping(lead_form)
+			rows.append(get_lead_log_row(account_name, lead_data, lead_form, mappings[lead_form]))
 	
-	# Parse field data
-	field_data = {}
-	for field in lead_data.get("field_data", []):
-		field_data[field.get("name")] = field.get("values", [None])[0]
+	# Create lead logs
+	lead_logs = bulk_insert_docs("Facebook Lead Log", rows)
+	if remember:
+		mark_seen_after_commit("lead", [row["fb_leadgen_id"] for row in lead_logs])
 	
-	lead_log.email = field_data.get("email")
-	lead_log.phone = field_data.get("phone_number")
-	lead_log.full_name = field_data.get("full_name")
-	lead_log.company_name = field_data.get("company_name")
+	# Auto-create ERPNext Leads if enabled
+	account = get_account_context(account_name)
+	if create_documents and account.default_lead_owner and lead_logs:
+		create_erp_docs("Lead", lead_logs)
 	
-	lead_log.insert(ignore_permissions=True)
+	return lead_logs
+
+def get_lead_log_row(account_name, lead_data, form_id=None, mapping=None):
+	"""Build a Facebook Lead Log row from a Graph lead object"""
+	form_id = form_id or lead_data.get("form_id")
+	log_values, lead_values = apply_form_mapping(mapping or get_form_mapping(form_id), lead_data.get("field_data"))
+	
+	return {
+		"facebook_account": account_name,
+		"fb_leadgen_id": lead_data.get("id"),
+		"form_id": form_id,
+		"created_at": parse_graph_time(lead_data.get("created_time")) or frappe.utils.now(),
+		"data": frappe.as_json(lead_data),
+		"lead_values": frappe.as_json(lead_values) if lead_values else None,
+		**log_values
+	}
+
+def create_erp_docs(doctype, lead_logs):
+	"""Create ERPNext documents of `doctype` for lead log rows
+	
+	Leads whose email or phone already belongs to a document of `doctype`
+	are linked to it instead of creating a duplicate. Each insert runs under
+	a savepoint so one failing lead does not undo the others; the lead logs
+	are linked with one bulk update. Returns the number of lead logs mapped
+	and the names of the lead logs that failed.
+	"""
+	link_field, build = MAP_TARGETS[doctype]
+	lead_logs = [frappe._dict(lead_log) for lead_log in lead_logs]
+	matches = match_documents(doctype, [(lead_log.email, lead_log.phone) for lead_log in lead_logs])
+	# Documents created in this chunk, so repeated leads link to the same record
+	created = {}
+	updates = {}
+	failed = []
+	
+	for lead_log, name in zip(lead_logs, matches):
+		keys = get_match_keys(lead_log.email, lead_log.phone)
+		name = name or next((created[key] for key in keys if key in created), None)
+		try:
+			if not name:
+				frappe.db.savepoint("facebook_map_lead")
+				account = get_account_context(lead_log.facebook_account) if lead_log.facebook_account else None
+				doc = build(lead_log, account)
+				doc.insert()
+				name = doc.name
+				created.update(dict.fromkeys(keys, name))
+			
+			updates[lead_log.name] = {
+				link_field: name,
+				"mapped_to": doctype,
+				"mapped_document": name,
+				"synced": 1
+			}
+		except Exception as e:
+			frappe.db.rollback(save_point="facebook_map_lead")
+			failed.append(lead_log.name)
+			frappe.log_error(f"{doctype} creation failed for {lead_log.name}: {str(e)}")
+	
+	if updates:
+		frappe.db.bulk_update("Facebook Lead Log", updates)
 	
-	# Auto-create ERPNext Lead if enabled
-	account = frappe.get_doc("Facebook Account", account_name)
-	if account.default_lead_owner:
-		create_erp_lead(lead_log)
+	return len(updates), failed
+
+def get_erp_lead(lead_log, account=None):
+	"""Build an unsaved ERPNext Lead from a Facebook Lead Log"""
+	lead = frappe.new_doc("Lead")
+	lead.lead_name = lead_log.full_name or "Facebook Lead"
+	lead.email_id = lead_log.email
+	lead.mobile_no = lead_log.phone
+	lead.company_name = lead_log.company_name
+	lead.source = "Facebook"
+	lead.lead_owner = account.default_lead_owner if account else None
+	# Answers mapped to Lead fields by the form's field mapping
+	lead.update(frappe.parse_json(lead_log.lead_values) or {})
+	return lead
+
+def get_erp_contact(lead_log, account=None):
+	"""Build an unsaved ERPNext Contact from a Facebook Lead Log"""
+	contact = frappe.new_doc("Contact")
+	contact.first_name = lead_log.full_name or "Facebook Contact"
+	contact.email_id = lead_log.email
+	contact.mobile_no = lead_log.phone
+	return contact
+
+def get_erp_customer(lead_log, account=None):
+	"""Build an unsaved ERPNext Customer from a Facebook Lead Log"""
+	customer = frappe.new_doc("Customer")
+	customer.customer_name = lead_log.full_name or "Facebook Customer"
+	customer.customer_type = "Individual"
+	customer.email_id = lead_log.email
+	customer.mobile_no = lead_log.phone
+	return customer
+
+# Target doctype -> (Facebook Lead Log link field, document builder)
+MAP_TARGETS = {
+	"Lead": ("lead", get_erp_lead),
+	"Contact": ("contact", get_erp_contact),
+	"Customer": ("customer", get_erp_customer),
+}
 
 def create_erp_lead(lead_log):
 	"""Create ERPNext Lead from Facebook Lead"""
-	try:
-		lead = frappe.new_doc("Lead")
-		lead.lead_name = lead_log.full_name or "Facebook Lead"
-		lead.email_id = lead_log.email
-		lead.mobile_no = lead_log.phone
-		lead.company_name = lead_log.company_name
-		lead.source = "Facebook"
-		lead.lead_owner = frappe.db.get_value("Facebook Account", lead_log.facebook_account, "default_lead_owner")
-		
-		lead.insert()
-		
-		lead_log.lead = lead.name
-		lead_log.synced = 1
-		lead_log.save()
-		
-		return {"status": "success", "lead": lead.name}
-	except Exception as e:
-		frappe.log_error(f"Lead creation failed: {str(e)}")
-		return {"status": "error", "message": str(e)}
+	return create_erp_doc("Lead", lead_log)
 
 def create_erp_contact(lead_log):
 	"""Create ERPNext Contact from Facebook Lead"""
-	try:
-		contact = frappe.new_doc("Contact")
-		contact.first_name = lead_log.full_name or "Facebook Contact"
-		contact.email_id = lead_log.email
-		contact.mobile_no = lead_log.phone
-		
-		contact.insert()
-		
-		lead_log.contact = contact.name
-		lead_log.synced = 1
-		lead_log.save()
-		
-		return {"status": "success", "contact": contact.name}
-	except Exception as e:
-		frappe.log_error(f"Contact creation failed: {str(e)}")
-		return {"status": "error", "message": str(e)}
+	return create_erp_doc("Contact", lead_log)
 
 def create_erp_customer(lead_log):
 	"""Create ERPNext Customer from Facebook Lead"""
+	return create_erp_doc("Customer", lead_log)
+
+def create_erp_doc(doctype, lead_log):
+	"""Link a Facebook Lead Log to a matching document of `doctype`, creating one if none exists"""
+	link_field, build = MAP_TARGETS[doctype]
 	try:
-		customer = frappe.new_doc("Customer")
-		customer.customer_name = lead_log.full_name or "Facebook Customer"
-		customer.customer_type = "Individual"
-		customer.email_id = lead_log.email
-		customer.mobile_no = lead_log.phone
+		name = match_documents(doctype, [(lead_log.email, lead_log.phone)])[0]
+		if not name:
+			account = get_account_context(lead_log.facebook_account) if lead_log.facebook_account else None
+			doc = build(lead_log, account)
+			doc.insert()
+			name = doc.name
 		
-		customer.insert()
-		
-		lead_log.customer = customer.name
-		lead_log.synced = 1
+		lead_log.update({
+			link_field: name,
+			"mapped_to": doctype,
+			"mapped_document": name,
+			"synced": 1
+		})
 		lead_log.save()
 		
-		return {"status": "success", "customer": customer.name}
+		return {"status": "success", link_field: name}
 	except Exception as e:
-		frappe.log_error(f"Customer creation failed: {str(e)}")
+		frappe.log_error(f"{doctype} creation failed: {str(e)}")
 		return {"status": "error", "message": str(e)}
 
 def handle_lead_webhook(account_name, leadgen_data):
 	"""Handle lead webhook from Facebook"""
+	handle_lead_webhooks(account_name, [leadgen_data])
+
+def handle_lead_webhooks(account_name, leadgen_values):
+	"""Handle all leadgen changes of one account in a webhook delivery
+	
+	Lead details are fetched through Graph batch requests, so a delivery
+	with many leads costs one round-trip per 50 leads.
+	"""
 	try:
-		lead_id = leadgen_data.get("leadgen_id")
-		
-		# Fetch full lead data from Facebook API
-		account = frappe.get_doc("Facebook Account", account_name)
-		url = f"https://graph.facebook.com/v18.0/{lead_id}"
-		params = {
-			"access_token": account.get_password("access_token"),
-			"fields": "id,created_time,field_data"
-		}
+		fetch_and_ingest_leads(account_name, leadgen_values)
+	except Exception as e:
+		frappe.log_error(f"Lead webhook handling failed: {str(e)}")
+
+def fetch_and_ingest_leads(account_name, leadgen_values):
+	"""Fetch the leads of leadgen values with Graph batch requests and ingest them"""
+	leads, failed = fetch_lead_events(account_name, leadgen_values)
+	for value, error in failed:
+		frappe.log_error(f"Lead fetch failed for {value.get('leadgen_id')}: {error}")
+	
+	return ingest_leads(account_name, leads)
+
+def fetch_lead_events(account_name, leadgen_values):
+	"""Fetch the leads of leadgen values with Graph batch requests
+	
+	Returns (leads, failed) with failed as [(leadgen value, error message)].
+	Leads already stored are skipped.
+	"""
+	# Redeliveries of known leads need no Graph API call
+	lead_ids = filter_unseen("lead", [value.get("leadgen_id") for value in leadgen_values])
+	if not lead_ids:
+		return [], []
+	
+	# Fetch full lead data from Facebook API
+	account = get_account_context(account_name)
+	results = get_graph_client(account).batch([
+		{"path": lead_id, "params": {"fields": "id,created_time,field_data,form_id"}}
+		for lead_id in lead_ids
+	])
+	
+	values = {value.get("leadgen_id"): value for value in leadgen_values}
+	leads, failed = [], []
+	for lead_id, lead_data in zip(lead_ids, results):
+		if "error" in lead_data:
+			failed.append((values[lead_id], lead_data["error"].get("message")))
+			continue
+		leads.append(lead_data)
+	
+	return leads, failed
+
+# Lead pipeline
+# -------------
+# Leadgen webhook events are pushed onto a Redis list per account. One
+# process_lead_data job per account drains the list in micro-batches: each
+# batch is fetched with one Graph batch request, mapped, deduplicated and
+# stored with one bulk insert, and ERPNext documents are created for it.
+# Accounts with pending events are kept in a set so the scheduler can
+# restart a drain that ended just before new events arrived. Events whose
+# lead could not be fetched or stored are put back with their attempt count
+# and retried one at a time on the next run; an event failing
+# MAX_LEAD_EVENT_ATTEMPTS times is logged and moved to the account's
+# dead-letter list. Taken events sit in a processing list until their batch
+# is committed; the next drain puts back what a killed worker left there.
+
+LEAD_PIPELINE_BATCH_SIZE = 50
+LEAD_PIPELINE_ACCOUNTS_KEY = "facebook_lead_pipeline_accounts"
+MAX_LEAD_EVENT_ATTEMPTS = 5
+
+POP_LEAD_EVENTS_SCRIPT = """
+local values = redis.call("lrange", KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #values > 0 then
+	redis.call("ltrim", KEYS[1], #values, -1)
+	redis.call("rpush", KEYS[2], unpack(values))
+end
+return values
+"""
+
+def get_lead_pipeline_key(account_name):
+	return frappe.cache().make_key(f"facebook_lead_pipeline|{account_name}")
+
+def get_lead_processing_key(account_name):
+	return frappe.cache().make_key(f"facebook_lead_pipeline_processing|{account_name}")
+
+def get_lead_dead_letter_key(account_name):
+	return frappe.cache().make_key(f"facebook_lead_pipeline_dead|{account_name}")
+
+def queue_lead_events(account_name, leadgen_values):
+	"""Queue leadgen webhook values for the account's lead pipeline"""
+	leadgen_ids = set(filter_unseen("lead", [value.get("leadgen_id") for value in leadgen_values]))
+	values = [value for value in leadgen_values if value.get("leadgen_id") in leadgen_ids]
+	if not values:
+		return
+	
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	pipe.rpush(get_lead_pipeline_key(account_name), *[json.dumps(value) for value in values])
+	pipe.sadd(cache.make_key(LEAD_PIPELINE_ACCOUNTS_KEY), account_name)
+	pipe.execute()
+	
+	enqueue_lead_pipeline(account_name)
+
+def enqueue_lead_pipeline(account_name):
+	enqueue_event_job("lead", "facebook_integration.api.webhook.process_lead_data",
+		account_name=account_name,
+		job_id=f"facebook_lead_pipeline|{account_name}",
+		deduplicate=True)
+
+def pop_lead_events(account_name, batch_size=LEAD_PIPELINE_BATCH_SIZE):
+	"""Atomically move up to `batch_size` queued leadgen values to the processing list"""
+	pop = frappe.cache().register_script(POP_LEAD_EVENTS_SCRIPT)
+	values = pop(keys=[get_lead_pipeline_key(account_name), get_lead_processing_key(account_name)], args=[batch_size])
+	return [json.loads(value) for value in values]
+
+def ack_lead_events(account_name):
+	"""Drop the processing list once its events are committed or put back"""
+	frappe.cache().delete(get_lead_processing_key(account_name))
+
+def recover_lead_events(account_name):
+	"""Put back the events a killed drain left in the processing list, counting an attempt"""
+	values = frappe.cache().lrange(get_lead_processing_key(account_name), 0, -1)
+	if values:
+		requeue_lead_events(account_name,
+			[(json.loads(value), "Lead pipeline stopped while processing the event") for value in values], [])
+		ack_lead_events(account_name)
+
+def drain_lead_pipeline(account_name, batch_size=LEAD_PIPELINE_BATCH_SIZE):
+	"""Process the account's queued leadgen events, committing after each micro-batch"""
+	recover_lead_events(account_name)
+	while True:
+		values = pop_lead_events(account_name, batch_size)
+		if not values:
+			return
 		
-		response = requests.get(url, params=params)
-		lead_data = response.json()
+		# Events that failed before go one by one, so a bad lead cannot hold back the rest
+		batches = [[value] for value in values if value.get("attempts")]
+		fresh = [value for value in values if not value.get("attempts")]
+		if fresh:
+			batches.append(fresh)
 		
-		if "error" not in lead_data:
-			process_facebook_lead(account_name, lead_data)
+		for i, batch in enumerate(batches):
+			try:
+				# Redeliveries within the burst are fetched once
+				leads, failed = fetch_lead_events(account_name,
+					list({value.get("leadgen_id"): value for value in batch}.values()))
+				ingest_leads(account_name, leads)
+				frappe.db.commit()
+			except Exception as e:
+				frappe.db.rollback()
+				failed = [(value, str(e)) for value in batch]
+			
+			pending = [value for rest in batches[i + 1:] for value in rest]
+			if failed and requeue_lead_events(account_name, failed, pending):
+				ack_lead_events(account_name)
+				# Back off; the scheduler restarts the drain
+				return
 		
-	except Exception as e:
-		frappe.log_error(f"Lead webhook handling failed: {str(e)}")
+		ack_lead_events(account_name)
+
+def requeue_lead_events(account_name, failed, pending):
+	"""Put failed leadgen values back in front of the queue, counting the attempt
+	
+	`failed` is [(leadgen value, error message)]. Values out of attempts are
+	logged and moved to the dead-letter list. Returns True if any value was
+	put back; `pending` values are then put back behind them.
+	"""
+	retry, dead = [], []
+	for value, error in failed:
+		value = {**value, "attempts": frappe.utils.cint(value.get("attempts")) + 1}
+		if value["attempts"] < MAX_LEAD_EVENT_ATTEMPTS:
+			retry.append(value)
+			continue
+		dead.append(value)
+		frappe.log_error(f"Lead pipeline gave up on leadgen {value.get('leadgen_id')} for {account_name}: {error}")
+	
+	cache = frappe.cache()
+	if dead:
+		frappe.db.commit()
+		cache.rpush(get_lead_dead_letter_key(account_name), *[json.dumps(value) for value in dead])
+	
+	if not retry:
+		return False
+	
+	cache.lpush(get_lead_pipeline_key(account_name), *[json.dumps(value) for value in reversed(retry + pending)])
+	return True
+
+def enqueue_lead_pipelines():
+	"""Scheduler backstop: start a drain for every account with queued leadgen events"""
+	cache = frappe.cache()
+	accounts_key = cache.make_key(LEAD_PIPELINE_ACCOUNTS_KEY)
+	for account_name in cache.smembers(accounts_key):
+		account_name = frappe.safe_decode(account_name)
+		if cache.llen(get_lead_pipeline_key(account_name)) or cache.llen(get_lead_processing_key(account_name)):
+			enqueue_lead_pipeline(account_name)
+		else:
+			cache.srem(accounts_key, account_name)
+
+def refresh_lead_log(lead_log_name):
+	"""Fetch the details of a lead log stored from a bare leadgen event"""
+	lead_log = frappe.db.get_value("Facebook Lead Log", lead_log_name,
+		["name", "facebook_account", "fb_leadgen_id", "form_id", "synced"], as_dict=True)
+	if not lead_log or not lead_log.facebook_account or lead_log.synced:
+		return
+	
+	lead_data = get_graph_client(lead_log.facebook_account).get(lead_log.fb_leadgen_id,
+		params={"fields": "id,created_time,field_data,form_id"})
+	if "error" in lead_data:
+		raise GraphAPIError(lead_data)
+	
+	row = get_lead_log_row(lead_log.facebook_account, lead_data, lead_log.form_id)
+	frappe.db.set_value("Facebook Lead Log", lead_log_name, row)
+	
+	if get_account_context(lead_log.facebook_account).default_lead_owner:
+		create_erp_docs("Lead", [{**row, "name": lead_log_name}])
 
 @frappe.whitelist()
-def get_unmapped_leads(account_name=None, limit=50):
-	"""Get unmapped Facebook leads"""
+def get_unmapped_leads(account_name=None, limit=50, cursor=None):
+	"""Get unmapped Facebook leads, newest first
+	
+	Pass the returned `next_cursor` as `cursor` to get the next page.
+	"""
 	try:
-		filters = {"synced": 0}
+		limit = get_page_size(limit)
+		filters, or_filters = get_keyset_filters(cursor)
+		filters.append(["synced", "=", 0])
 		if account_name:
-			filters["facebook_account"] = account_name
+			filters.append(["facebook_account", "=", account_name])
 			
 		leads = frappe.get_list(
 			"Facebook Lead Log",
 			filters=filters,
-			fields=["*"],
-			order_by="created_at desc",
+			or_filters=or_filters,
+			fields=LEAD_LIST_FIELDS,
+			order_by="creation desc, name desc",
 			limit=limit
 		)
 		
 		return {
 			"success": True,
-			"leads": leads
+			"leads": leads,
+			"next_cursor": get_next_cursor(leads, limit)
 		}
 		
 	except Exception as e:
@@ -189,4 +639,4 @@ def get_unmapped_leads(account_name=None, limit=50):
 		return {
 			"success": False,
 			"error": str(e)
-		}
\ No newline at end of file
+		}
@@ -1,86 +1,224 @@
 import frappe
-import requests
 import json
+import time
+import requests
 from frappe import _
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.api.conversations import get_conversation_name, get_conversation_rows, set_message_conversation, update_conversations
+from facebook_integration.api.graph import RETRY_ERROR_CODES, GraphRateLimitError, get_error_code, get_graph_client
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import bulk_insert_docs, filter_unseen, get_keyset_filters, get_next_cursor, get_page_size, mark_seen
+
+# Columns returned by the message list APIs
+MESSAGE_LIST_FIELDS = [
+	"name", "creation", "conversation", "facebook_account", "sender_id", "sender_name",
+	"recipient_id", "content", "message_type", "media_url", "direction", "status",
+	"received_at", "sent_at",
+]
+
+# Outbound queue
+# --------------
+# send_message() only stores a queued Facebook Message Log. One sender job
+# per account (deduplicated by job id) sends the queued logs oldest first,
+# spaced per page, and writes the results back in batches. Failures Graph
+# reports as temporary are retried with exponential backoff; a scheduler
+# backstop restarts senders for logs whose retry time has come.
+
+OUTBOUND_BATCH_SIZE = 50
+MAX_SEND_ATTEMPTS = 5
+SEND_RETRY_BACKOFF = 30
+# Messages per second sent to one page, `facebook_send_rate` site config key
+DEFAULT_SEND_RATE = 10
+SEND_SLOT_TTL = 60
+
+# Reserves the next send slot of a page and returns it as a string, since
+# Redis would truncate a Lua number reply to an integer
+RESERVE_SEND_SLOT_SCRIPT = """
+local slot = math.max(tonumber(ARGV[1]), tonumber(redis.call("get", KEYS[1]) or "0"))
+redis.call("set", KEYS[1], tostring(slot + tonumber(ARGV[2])), "ex", ARGV[3])
+return tostring(slot)
+"""
+
+# Seconds behind the change cursor that are read again, so rows committed
+# after a later-modified row was already returned are not missed
+CHANGE_OVERLAP = 10
 
 @frappe.whitelist()
 def send_message(account_name, recipient_id, message_text):
-	"""Send message via Facebook Messenger API"""
-	try:
-		account = frappe.get_doc("Facebook Account", account_name)
-		
-		if not account.enabled or not account.enable_messenger:
-			frappe.throw(_("Messenger integration is not enabled"))
-		
-		# Prepare API request
-		url = f"https://graph.facebook.com/v18.0/me/messages"
+	"""Send message via Facebook Messenger API
+	
+	Returns as soon as the message is queued; the Facebook Message Log
+	moves from queued to sent or failed once a worker sent it.
+	"""
+	account = get_account_context(account_name)
+	
+	if not account.enabled or not account.enable_messenger:
+		frappe.throw(_("Messenger integration is not enabled"))
+	
+	message_log = frappe.new_doc("Facebook Message Log")
+	message_log.facebook_account = account_name
+	message_log.sender_id = account.page_id
+	message_log.recipient_id = recipient_id
+	message_log.content = message_text
+	message_log.direction = "outgoing"
+	message_log.status = "queued"
+	message_log.message_type = "text"
+	set_message_conversation(message_log)
+	# The conversation must exist before insert() validates the link to it
+	update_conversations([message_log.as_dict()])
+	message_log.insert(ignore_permissions=True)
+	publish_message_changes([message_log.as_dict()], after_commit=True)
+	
+	enqueue_outbound_sender(account_name, enqueue_after_commit=True)
+	
+	return {
+		"success": True,
+		"queued": True,
+		"message_log": message_log.name,
+		"recipient_id": recipient_id
+	}
+
+def enqueue_outbound_sender(account_name, **kwargs):
+	enqueue_event_job("message", "facebook_integration.api.messaging.send_queued_messages",
+		account_name=account_name,
+		job_id=f"facebook_outbound|{account_name}",
+		deduplicate=True,
+		**kwargs)
+
+def enqueue_outbound_senders():
+	"""Scheduler backstop: start a sender for every account with messages due"""
+	for account_name in frappe.get_all("Facebook Message Log",
+		filters={"status": "queued", "direction": "outgoing"},
+		or_filters=get_due_message_or_filters(),
+		distinct=True,
+		pluck="facebook_account"):
+		enqueue_outbound_sender(account_name)
+
+def get_due_message_or_filters():
+	"""Queued messages without a retry time, or whose retry time has come"""
+	return [
+		["next_attempt_at", "is", "not set"],
+		["next_attempt_at", "<=", frappe.utils.now()],
+	]
+
+def get_send_interval():
+	return 1 / (frappe.utils.flt(frappe.conf.get("facebook_send_rate")) or DEFAULT_SEND_RATE)
+
+class SendRateLimiter:
+	"""Hands out send slots to one page spaced `interval` seconds apart
+	
+	The next free slot is kept in Redis, so the outbound sender and
+	broadcast threads of the same page share one rate.
+	"""
+
+	def __init__(self, page_id, interval=None):
+		self.cache = frappe.cache()
+		# Resolve the site-prefixed key here, so threads can share the limiter
+		self.key = self.cache.make_key(f"facebook_send_slot|{page_id}")
+		self.interval = interval or get_send_interval()
+		self.reserve = self.cache.register_script(RESERVE_SEND_SLOT_SCRIPT)
+
+	def wait(self):
+		now = time.time()
+		slot = float(self.reserve(keys=[self.key], args=[now, self.interval, SEND_SLOT_TTL]))
+		if slot > now:
+			time.sleep(slot - now)
+
+def send_queued_messages(account_name):
+	"""Send the account's due queued messages, writing results back per batch"""
+	account = get_account_context(account_name)
+	client = get_graph_client(account)
+	limiter = SendRateLimiter(account.page_id or account_name)
+	
+	while True:
+		messages = frappe.get_all("Facebook Message Log",
+			filters={"facebook_account": account_name, "status": "queued", "direction": "outgoing"},
+			or_filters=get_due_message_or_filters(),
+			fields=[*MESSAGE_LIST_FIELDS, "send_attempts"],
+			order_by="creation asc",
+			limit=OUTBOUND_BATCH_SIZE)
+		if not messages:
+			return
 		
-		headers = {
-			"Content-Type": "application/json"
+		updates = {}
+		sent = []
+		try:
+			for message in messages:
+				limiter.wait()
+				# Retry results carry no status; the message stays queued
+				updates[message.name] = result = send_queued_message(client, message)
+				if result.get("status") == "sent":
+					sent.append({**message, **result})
+				elif result.get("status") == "failed":
+					frappe.log_error(f"Facebook API Error: {result['error']}")
+		finally:
+			# Write back what was sent even if a later send raised, so it is not sent again
+			if updates:
+				frappe.db.bulk_update("Facebook Message Log", updates)
+				bulk_insert_docs("Communication", [get_communication_row(message) for message in sent])
+				frappe.db.commit()
+				publish_message_changes([{**message, **updates[message.name]} for message in messages if message.name in updates])
+
+def send_queued_message(client, message):
+	"""Send one queued message and return the field values to write back
+	
+	Needs no database access, so broadcast sender threads can call it.
+	"""
+	attempts = frappe.utils.cint(message.send_attempts) + 1
+	try:
+		response_data = client.post("me/messages", json={
+			"recipient": {"id": message.recipient_id},
+			"message": {"text": message.content}
+		})
+	except (requests.ConnectionError, requests.Timeout) as e:
+		response_data = {"error": {"message": str(e), "code": 2}}
+	except GraphRateLimitError as e:
+		response_data = e.data
+	
+	if "error" not in response_data:
+		return {
+			"status": "sent",
+			"message_id": response_data.get("message_id"),
+			"sent_at": frappe.utils.now(),
+			"send_attempts": attempts,
+			"error": None
 		}
-		
-		payload = {
-			"recipient": {"id": recipient_id},
-			"message": {"text": message_text},
-			"access_token": account.get_password("access_token")
+	
+	error_msg = response_data.get("error", {}).get("message", "Unknown error")
+	if get_error_code(response_data) in RETRY_ERROR_CODES and attempts < MAX_SEND_ATTEMPTS:
+		return {
+			"send_attempts": attempts,
+			"next_attempt_at": frappe.utils.add_to_date(None, seconds=SEND_RETRY_BACKOFF * 2 ** (attempts - 1)),
+			"error": error_msg
 		}
-		
-		# Send request to Facebook
-		response = requests.post(url, headers=headers, json=payload)
-		response_data = response.json()
-		
-		if response.status_code == 200:
-			# Log successful message
-			message_log = frappe.new_doc("Facebook Message Log")
-			message_log.facebook_account = account_name
-			message_log.message_id = response_data.get("message_id")
-			message_log.sender_id = account.page_id
-			message_log.recipient_id = recipient_id
-			message_log.content = message_text
-			message_log.direction = "outgoing"
-			message_log.status = "sent"
-			message_log.message_type = "text"
-			message_log.sent_at = frappe.utils.now()
-			
-			message_log.insert(ignore_permissions=True)
-			frappe.db.commit()
-			
-			# Create Communication record
-			create_communication_record(message_log)
-			
-			return {
-				"success": True,
-				"message_id": response_data.get("message_id"),
-				"recipient_id": response_data.get("recipient_id")
-			}
-		else:
-			error_msg = response_data.get("error", {}).get("message", "Unknown error")
-			frappe.log_error(f"Facebook API Error: {error_msg}")
-			frappe.throw(_(f"Failed to send message: {error_msg}"))
-			
-	except Exception as e:
-		frappe.log_error(f"Send message failed: {str(e)}")
-		frappe.throw(_(f"Failed to send message: {str(e)}"))
+	
+	return {"status": "failed", "send_attempts": attempts, "error": error_msg}
 
 @frappe.whitelist()
-def get_messages(account_name=None, limit=50):
-	"""Get Facebook messages for UI"""
+def get_messages(account_name=None, limit=50, cursor=None):
+	"""Get Facebook messages for UI, newest first
+	
+	Pass the returned `next_cursor` as `cursor` to get the next page.
+	"""
 	try:
-		filters = {}
+		limit = get_page_size(limit)
+		filters, or_filters = get_keyset_filters(cursor)
 		if account_name:
-			filters["facebook_account"] = account_name
+			filters.append(["facebook_account", "=", account_name])
 			
 		messages = frappe.get_list(
 			"Facebook Message Log",
 			filters=filters,
-			fields=["*"],
-			order_by="received_at desc, sent_at desc",
+			or_filters=or_filters,
+			fields=MESSAGE_LIST_FIELDS,
+			order_by="creation desc, name desc",
 			limit=limit
 		)
 		
 		return {
 			"success": True,
-			"messages": messages
+			"messages": messages,
+			"next_cursor": get_next_cursor(messages, limit)
 		}
 		
 	except Exception as e:
@@ -91,25 +229,31 @@ def get_messages(account_name=None, limit=50):
 		}
 
 @frappe.whitelist()
-def get_conversation(sender_id, account_name):
-	"""Get conversation thread between sender and page"""
+def get_conversation(sender_id, account_name, limit=50, cursor=None):
+	"""Get conversation thread between sender and page
+	
+	Returns the newest page of the thread in chronological order;
+	`next_cursor` fetches the page of older messages before it.
+	"""
 	try:
-		account = frappe.get_doc("Facebook Account", account_name)
+		limit = get_page_size(limit)
+		filters, or_filters = get_keyset_filters(cursor)
+		filters.append(["conversation", "=", get_conversation_name(account_name, sender_id)])
 		
 		messages = frappe.get_list(
 			"Facebook Message Log",
-			filters={
-				"facebook_account": account_name,
-				"sender_id": ["in", [sender_id, account.page_id]],
-				"recipient_id": ["in", [sender_id, account.page_id]]
-			},
-			fields=["*"],
-			order_by="received_at asc, sent_at asc"
+			filters=filters,
+			or_filters=or_filters,
+			fields=MESSAGE_LIST_FIELDS,
+			order_by="creation desc, name desc",
+			limit=limit
 		)
+		next_cursor = get_next_cursor(messages, limit)
 		
 		return {
 			"success": True,
-			"messages": messages
+			"messages": messages[::-1],
+			"next_cursor": next_cursor
 		}
 		
 	except Exception as e:
@@ -119,48 +263,185 @@ def get_conversation(sender_id, account_name):
 			"error": str(e)
 		}
 
+@frappe.whitelist()
+def get_message_changes(account_name, cursor=None, limit=100):
+	"""Get messages of an account created or updated after `cursor`
+	
+	Clients apply the changes and keep the returned cursor; without a
+	cursor, only the current cursor is returned. Conversations of the
+	changed messages are included. Messages modified shortly before the
+	cursor are returned again, so clients must apply changes by name.
+	"""
+	try:
+		if not cursor:
+			return {"success": True, "messages": [], "conversations": [], "cursor": f"{frappe.utils.now()}|"}
+		
+		limit = get_page_size(limit, default=100)
+		filters, or_filters = get_keyset_filters(cursor, field="modified", ascending=True)
+		filters.append(["facebook_account", "=", account_name])
+		
+		messages = frappe.get_list(
+			"Facebook Message Log",
+			filters=filters,
+			or_filters=or_filters,
+			fields=[*MESSAGE_LIST_FIELDS, "modified"],
+			order_by="modified asc, name asc",
+			limit=limit
+		)
+		
+		modified = cursor.split("|", 1)[0]
+		since = frappe.utils.add_to_date(frappe.utils.get_datetime(modified), seconds=-CHANGE_OVERLAP)
+		overlap = frappe.get_list(
+			"Facebook Message Log",
+			filters=[["facebook_account", "=", account_name], ["modified", ">=", since], ["modified", "<=", modified]],
+			fields=[*MESSAGE_LIST_FIELDS, "modified"],
+			order_by="modified asc, name asc",
+			limit=limit
+		)
+		changes = list({message.name: message for message in overlap + messages}.values())
+		
+		return {
+			"success": True,
+			"messages": changes,
+			"conversations": get_conversation_rows(message.conversation for message in changes),
+			"cursor": get_change_cursor(messages) or cursor,
+			"has_more": len(messages) == limit
+		}
+		
+	except Exception as e:
+		frappe.log_error(f"Get message changes failed: {str(e)}")
+		return {
+			"success": False,
+			"error": str(e)
+		}
+
+def get_change_cursor(message_logs):
+	"""Return the change cursor after the latest of the rows, if they all carry `modified`"""
+	if not message_logs or not all(msg_log.get("modified") for msg_log in message_logs):
+		return None
+	latest = max(message_logs, key=lambda msg_log: (str(msg_log.get("modified")), msg_log.get("name")))
+	return f"{latest.get('modified')}|{latest.get('name')}"
+
+def publish_message_changes(message_logs, after_commit=False):
+	"""Push new or updated messages and their conversations to each account's room
+	
+	Clients subscribed to the Facebook Account document apply the delta
+	instead of re-fetching their lists.
+	"""
+	by_account = {}
+	for msg_log in message_logs:
+		if msg_log.get("facebook_account"):
+			by_account.setdefault(msg_log.get("facebook_account"), []).append(msg_log)
+	if not by_account:
+		return
+	
+	conversations = {}
+	for conversation in get_conversation_rows(msg_log.get("conversation") for msg_log in message_logs):
+		conversations.setdefault(conversation.facebook_account, []).append(conversation)
+	
+	for account_name, account_logs in by_account.items():
+		frappe.publish_realtime("facebook_message_changes", {
+			"account": account_name,
+			"messages": [{field: msg_log.get(field) for field in MESSAGE_LIST_FIELDS} for msg_log in account_logs],
+			"conversations": conversations.get(account_name, []),
+			"cursor": get_change_cursor(account_logs)
+		}, doctype="Facebook Account", docname=account_name, after_commit=after_commit)
+
 def handle_message_webhook(account_name, messaging_data):
 	"""Handle incoming message from webhook"""
+	save_message_events([(account_name, messaging_data)])
+
+def save_message_events(account_events, create_communications=True, raise_errors=False):
+	"""Persist all messaging events of one webhook delivery in a single batch
+	
+	`account_events` is a list of (account_name, messaging_event). Known
+	message ids are filtered with one query, new Facebook Message Log and
+	Communication rows are written with multi-row inserts and one commit.
+	Errors are logged, or raised after the rollback with `raise_errors`.
+	"""
 	try:
-		message = messaging_data.get("message", {})
-		sender = messaging_data.get("sender", {})
-		
-		msg_log = frappe.new_doc("Facebook Message Log")
-		msg_log.facebook_account = account_name
-		msg_log.message_id = message.get("mid")
-		msg_log.sender_id = sender.get("id")
-		msg_log.content = message.get("text", "")
-		msg_log.direction = "incoming"
-		msg_log.status = "received"
-		msg_log.received_at = frappe.utils.now()
-		
-		if "attachments" in message:
-			attachment = message["attachments"][0]
-			msg_log.message_type = attachment.get("type", "file")
-			msg_log.media_url = attachment.get("payload", {}).get("url")
-		else:
-			msg_log.message_type = "text"
-		
-		msg_log.insert(ignore_permissions=True)
-		
-		# Create Communication record
-		create_communication_record(msg_log)
+		# Drop redeliveries of recently persisted messages before building rows
+		unseen = set(filter_unseen("message",
+			[get_event_message_id(messaging_event) for _account, messaging_event in account_events]))
+		
+		rows = []
+		seen = set()
+		for account_name, messaging_event in account_events:
+			message_id = get_event_message_id(messaging_event)
+			if message_id and (message_id not in unseen or message_id in seen):
+				continue
+			row = parse_message_event(account_name, messaging_event)
+			if not row:
+				continue
+			seen.add(message_id)
+			rows.append(row)
+		
+		message_ids = [row["message_id"] for row in rows if row["message_id"]]
+		existing = set()
+		if message_ids:
+			existing = set(frappe.get_all("Facebook Message Log",
+				filters={"message_id": ["in", message_ids]},
+				pluck="message_id"))
+			rows = [row for row in rows if row["message_id"] not in existing]
+		
+		message_logs = bulk_insert_docs("Facebook Message Log", rows)
+		update_conversations(message_logs)
+		
+		if create_communications and message_logs:
+			bulk_insert_docs("Communication",
+				[get_communication_row(msg_log) for msg_log in message_logs])
+		
+		frappe.db.commit()
+		mark_seen("message", message_ids)
+		publish_message_changes(message_logs)
+		return message_logs
 		
 	except Exception as e:
+		frappe.db.rollback()
+		if raise_errors:
+			raise
 		frappe.log_error(f"Message webhook handling failed: {str(e)}")
+		return []
 
-def create_communication_record(msg_log):
-	"""Create ERPNext Communication record"""
-	try:
-		comm = frappe.new_doc("Communication")
-		comm.communication_type = "Communication"
-		comm.communication_medium = "Social Media"
-		comm.sent_or_received = "Received" if msg_log.direction == "incoming" else "Sent"
-		comm.content = msg_log.content
-		comm.subject = f"Facebook Message from {msg_log.sender_id}"
-		comm.sender = msg_log.sender_id
-		comm.reference_doctype = "Facebook Message Log"
-		comm.reference_name = msg_log.name
-		comm.insert(ignore_permissions=True)
-	except Exception as e:
-		frappe.log_error(f"Communication record creation failed: {str(e)}")
\ No newline at end of file
+def get_event_message_id(messaging_event):
+	return (messaging_event.get("message") or {}).get("mid")
+
+def parse_message_event(account_name, messaging_event):
+	"""Build a Facebook Message Log row from a Messenger webhook event"""
+	message = messaging_event.get("message")
+	if not message:
+		# Delivery, read and postback events carry no message
+		return None
+	
+	row = {
+		"facebook_account": account_name,
+		"message_id": message.get("mid"),
+		"sender_id": messaging_event.get("sender", {}).get("id"),
+		"recipient_id": messaging_event.get("recipient", {}).get("id"),
+		"content": message.get("text", ""),
+		"direction": "incoming",
+		"status": "received",
+		"received_at": frappe.utils.now(),
+		"message_type": "text"
+	}
+	
+	if "attachments" in message:
+		attachment = message["attachments"][0]
+		row["message_type"] = attachment.get("type", "file")
+		row["media_url"] = attachment.get("payload", {}).get("url")
+	
+	return set_message_conversation(row)
+
+def get_communication_row(msg_log):
+	"""Build the Communication row mirroring a Facebook Message Log"""
+	return {
+		"communication_type": "Communication",
+		"communication_medium": "Social Media",
+		"communication_date": msg_log.get("received_at") or msg_log.get("sent_at") or frappe.utils.now(),
+		"sent_or_received": "Received" if msg_log.get("direction") == "incoming" else "Sent",
+		"content": msg_log.get("content"),
+		"subject": f"Facebook Message from {msg_log.get('sender_id')}",
+		"sender": msg_log.get("sender_id"),
+		"reference_doctype": "Facebook Message Log",
+		"reference_name": msg_log.get("name")
+	}
\ No newline at end of file
@@ -1,35 +1,31 @@
 import frappe
-import requests
 from frappe import _
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.api.graph import GraphAPIError, get_graph_client
+from facebook_integration.utils import is_seen, mark_seen, mark_seen_after_commit
 
 @frappe.whitelist()
 def sync_products(account_name):
 	"""Sync products from Facebook Shop to ERPNext"""
-	account = frappe.get_doc("Facebook Account", account_name)
+	account = get_account_context(account_name)
 	if not account.enable_shop:
 		return {"status": "error", "message": "Shop integration not enabled"}
 	
 	try:
 		# Get products from Facebook
-		url = f"https://graph.facebook.com/v18.0/{account.page_id}/products"
-		params = {
-			"access_token": account.get_password("access_token"),
-			"fields": "id,name,description,price,currency,availability,image_url"
-		}
-		
-		response = requests.get(url, params=params)
-		data = response.json()
-		
-		if "error" in data:
-			return {"status": "error", "message": data["error"]["message"]}
-		
 		synced_count = 0
-		for product in data.get("data", []):
-			sync_single_product(account, product)
-			synced_count += 1
+		for products in get_graph_client(account).paginate(f"{account.page_id}/products", params={
+			"fields": "id,name,description,price,currency,availability,image_url",
+			"limit": 100
+		}):
+			for product in products:
+				sync_single_product(account, product)
+				synced_count += 1
 		
 		return {"status": "success", "synced": synced_count}
 		
+	except GraphAPIError as e:
+		return {"status": "error", "message": str(e)}
 	except Exception as e:
 		frappe.log_error(f"Facebook Shop Sync Error: {str(e)}")
 		return {"status": "error", "message": str(e)}
@@ -63,7 +59,7 @@ def create_sales_order(order_id):
 @frappe.whitelist()
 def sync_inventory(account_name):
 	"""Sync inventory from ERPNext to Facebook Shop"""
-	account = frappe.get_doc("Facebook Account", account_name)
+	account = get_account_context(account_name)
 	if not account.enable_shop:
 		return {"status": "error", "message": "Shop integration not enabled"}
 	
@@ -73,37 +69,48 @@ def sync_inventory(account_name):
 		fields=["name", "facebook_product_id"]
 	)
 	
+	if not items:
+		return {"status": "success", "updated": 0}
+	
+	# Get current stock for all items in one query
+	stock = dict(frappe.get_all("Bin",
+		filters={
+			"item_code": ["in", [item.name for item in items]],
+			"warehouse": account.default_warehouse
+		},
+		fields=["item_code", "actual_qty"],
+		as_list=True
+	))
+	
+	# Update Facebook inventory through batched requests
+	results = get_graph_client(account).batch([
+		{
+			"method": "POST",
+			"path": item.facebook_product_id,
+			"data": {"inventory": int(stock.get(item.name) or 0)}
+		}
+		for item in items
+	])
+	
 	updated_count = 0
-	for item in items:
-		# Get current stock
-		stock_qty = frappe.db.get_value("Bin", 
-			{"item_code": item.name, "warehouse": account.default_warehouse}, 
-			"actual_qty") or 0
-		
-		# Update Facebook inventory
-		update_facebook_inventory(account, item.facebook_product_id, stock_qty)
-		updated_count += 1
+	for item, result in zip(items, results):
+		if "error" in result:
+			frappe.log_error(f"Inventory update failed for {item.name}: {result['error'].get('message')}")
+		else:
+			updated_count += 1
 	
 	return {"status": "success", "updated": updated_count}
 
-def update_facebook_inventory(account, product_id, qty):
-	"""Update inventory on Facebook"""
-	url = f"https://graph.facebook.com/v18.0/{product_id}"
-	data = {
-		"access_token": account.get_password("access_token"),
-		"inventory": int(qty)
-	}
-	
-	response = requests.post(url, data=data)
-	return response.json()
-
-def handle_order_webhook(account_name, order_data):
+def handle_order_webhook(account_name, order_data, raise_errors=False):
 	"""Handle Facebook Shop order webhook"""
 	try:
 		order_id = order_data.get("id")
 		
 		# Check if order already exists
+		if is_seen("order", order_id):
+			return
 		if frappe.db.exists("Facebook Shop Order", {"facebook_order_id": order_id}):
+			mark_seen("order", [order_id])
 			return
 		
 		# Create shop order record
@@ -127,6 +134,9 @@ def handle_order_webhook(account_name, order_data):
 			})
 		
 		shop_order.insert(ignore_permissions=True)
+		mark_seen_after_commit("order", [order_id])
 		
 	except Exception as e:
+		if raise_errors:
+			raise
 		frappe.log_error(f"Shop order webhook handling failed: {str(e)}")
\ No newline at end of file
@@ -3,6 +3,9 @@ import json
 import hmac
 import hashlib
 from frappe import _
+from facebook_integration.api.accounts import get_account_by_verify_token, get_route_by_page_id, get_routing_table
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import is_seen, mark_seen
 
 @frappe.whitelist(allow_guest=True, methods=["GET", "POST"])
 def webhook():
@@ -43,102 +46,104 @@ def verify_webhook():
 def process_webhook():
 	"""Process incoming Facebook webhook events"""
 	try:
-		# Verify signature
-		if not verify_signature():
-			frappe.throw(_("Invalid signature"), frappe.PermissionError)
-		
 		# Get request body
-		body = frappe.request.get_data(as_text=True)
-		data = json.loads(body)
+		body = frappe.request.get_data()
 		
-		# Process each entry
-		for entry in data.get("entry", []):
-			process_entry(entry)
+		# Verify signature
+		if not verify_signature(body):
+			frappe.throw(_("Invalid signature"), frappe.PermissionError)
 		
-		return {"status": "ok"}
+		if not is_ack_first_enabled():
+			process_webhook_payload(json.loads(body))
+			return {"status": "ok"}
 		
 	except Exception as e:
 		frappe.log_error(f"Webhook processing failed: {str(e)}")
 		return {"status": "error", "message": str(e)}
+	
+	# Journal errors propagate: Facebook only resends a delivery answered with a 5xx
+	journal_webhook("legacy", body.decode())
+	return {"status": "ok"}
+
+def process_webhook_payload(data, raise_errors=False):
+	"""Process a parsed delivery received on the legacy endpoint
+	
+	With `raise_errors`, handler errors propagate instead of being logged,
+	so the journal drain can retry the delivery.
+	"""
+	for entry in data.get("entry", []):
+		process_entry(entry, raise_errors)
 
-def verify_signature():
+def verify_signature(body=None):
 	"""Verify Facebook webhook signature"""
 	try:
-		settings = frappe.get_single("Facebook Settings")
-		signature = frappe.request.headers.get("X-Hub-Signature-256") or frappe.request.headers.get("X-Hub-Signature")
+		if body is None:
+			body = frappe.request.get_data()
 		
-		if not signature:
-			return False
-		
-		body = frappe.request.get_data()
-		
-		if signature.startswith("sha256="):
-			expected_signature = "sha256=" + hmac.new(
-				settings.app_secret.encode(),
-				body,
-				hashlib.sha256
-			).hexdigest()
-		else:
-			expected_signature = "sha1=" + hmac.new(
-				settings.app_secret.encode(),
-				body,
-				hashlib.sha1
-			).hexdigest()
-		
-		return hmac.compare_digest(signature, expected_signature)
+		key = get_routing_table().legacy_signing_key
+		return bool(key and get_signing_accounts(body, {key: True}))
 		
 	except Exception:
 		return False
 
-def process_entry(entry):
+def get_signing_accounts(body, signing_keys):
+	"""Return the value mapped to the signing key that produced the request signature
+	
+	`signing_keys` maps pre-encoded app secrets to the accounts using them.
+	Returns None when the signature header is missing or matches no key.
+	"""
+	signature = frappe.request.headers.get("X-Hub-Signature-256")
+	prefix, digestmod = "sha256=", hashlib.sha256
+	if not signature:
+		signature = frappe.request.headers.get("X-Hub-Signature")
+		prefix, digestmod = "sha1=", hashlib.sha1
+	
+	if not signature or not signature.startswith(prefix):
+		return None
+	
+	for key, accounts in signing_keys.items():
+		expected_signature = prefix + hmac.new(key, body, digestmod).hexdigest()
+		if hmac.compare_digest(signature, expected_signature):
+			return accounts
+	
+	return None
+
+def process_entry(entry, raise_errors=False):
 	"""Process a single webhook entry"""
 	
 	# Handle messaging events
 	if "messaging" in entry:
-		for messaging_event in entry["messaging"]:
-			process_message_event(messaging_event)
+		account = get_account_by_page_id(entry.get("id"))
+		process_message_events([(account, event) for event in entry["messaging"]], raise_errors)
 	
 	# Handle leadgen events
 	if "changes" in entry:
 		for change in entry["changes"]:
 			if change.get("field") == "leadgen":
-				process_leadgen_event(change["value"])
+				process_leadgen_event(change["value"], raise_errors)
 
 def process_message_event(messaging_event):
 	"""Process a messaging event"""
-	try:
-		message = messaging_event.get("message", {})
-		sender = messaging_event.get("sender", {})
-		recipient = messaging_event.get("recipient", {})
-		
-		# Create Facebook Message Log
-		message_log = frappe.new_doc("Facebook Message Log")
-		message_log.message_id = message.get("mid")
-		message_log.sender_id = sender.get("id")
-		message_log.recipient_id = recipient.get("id")
-		message_log.content = message.get("text", "")
-		message_log.direction = "incoming"
-		message_log.status = "received"
-		message_log.received_at = frappe.utils.now()
-		
-		# Handle different message types
-		if "attachments" in message:
-			attachment = message["attachments"][0]
-			message_log.message_type = attachment.get("type", "file")
-			message_log.media_url = attachment.get("payload", {}).get("url")
-		else:
-			message_log.message_type = "text"
-		
-		message_log.insert(ignore_permissions=True)
-		frappe.db.commit()
-		
-	except Exception as e:
-		frappe.log_error(f"Message processing failed: {str(e)}")
+	process_message_events([(None, messaging_event)])
 
-def process_leadgen_event(leadgen_data):
+def process_message_events(account_events, raise_errors=False):
+	"""Persist the messaging events of a legacy delivery in one batch"""
+	from facebook_integration.api.messaging import save_message_events
+	save_message_events(account_events, create_communications=False, raise_errors=raise_errors)
+
+def process_leadgen_event(leadgen_data, raise_errors=False):
 	"""Process a leadgen event"""
 	try:
-		# Create Facebook Lead Log
+		if is_seen("lead", leadgen_data.get("leadgen_id")):
+			return
+		
+		account = get_account_by_page_id(leadgen_data.get("page_id"))
+		if account:
+			# Fetched, mapped and stored in micro-batches by process_lead_data
+			process_account_leads(account, [leadgen_data])
+			return
+		
+		# Without an account the lead cannot be fetched; keep the event
 		lead_log = frappe.new_doc("Facebook Lead Log")
 		lead_log.fb_leadgen_id = leadgen_data.get("leadgen_id")
 		lead_log.page_id = leadgen_data.get("page_id")
@@ -148,15 +153,11 @@ def process_leadgen_event(leadgen_data):
 		
 		lead_log.insert(ignore_permissions=True)
 		frappe.db.commit()
-		
-		# Enqueue lead processing for background
-		frappe.enqueue(
-			"facebook_integration.api.webhook.process_lead_data",
-			lead_log_name=lead_log.name,
-			queue="default"
-		)
+		mark_seen("lead", [lead_log.fb_leadgen_id])
 		
 	except Exception as e:
+		if raise_errors:
+			raise
 		frappe.log_error(f"Leadgen processing failed: {str(e)}")
 
 def verify_multi_account_webhook():
@@ -165,10 +166,9 @@ def verify_multi_account_webhook():
 	token = frappe.form_dict.get("hub.verify_token")
 	challenge = frappe.form_dict.get("hub.challenge")
 	
-	accounts = frappe.get_all("Facebook Account", 
-		filters={"verify_token": token, "enabled": 1})
+	account = get_account_by_verify_token(token)
 	
-	if mode == "subscribe" and accounts:
+	if mode == "subscribe" and account:
 		frappe.response["type"] = "text"
 		return challenge
 	else:
@@ -176,51 +176,250 @@ def verify_multi_account_webhook():
 
 def process_multi_account_webhook():
 	"""Process webhook for multi-account setup"""
+	# Authenticate before any parsing or database work; the body is read once
+	body = frappe.request.get_data()
+	signed_accounts = get_signing_accounts(body, get_routing_table().signing_keys)
+	if not signed_accounts:
+		frappe.throw(_("Invalid signature"), frappe.PermissionError)
+	
+	if is_ack_first_enabled():
+		# Journal errors propagate: Facebook only resends a delivery answered with a 5xx
+		journal_webhook("multi_account", body.decode(), signed_accounts)
+		return "OK"
+	
 	try:
-		body = frappe.request.get_data(as_text=True)
-		data = json.loads(body)
-		
-		for entry in data.get("entry", []):
-			page_id = entry.get("id")
-			account = get_account_by_page_id(page_id)
-			
-			if not account:
-				continue
-			
-			for change in entry.get("changes", []):
-				process_account_change(account, change)
-			
-			for messaging in entry.get("messaging", []):
-				process_account_message(account, messaging)
+		process_multi_account_payload(json.loads(body), signed_accounts)
 		
 		return "OK"
 	except Exception as e:
 		frappe.log_error(f"Multi-account webhook error: {str(e)}")
 		return "ERROR"
 
+def process_multi_account_payload(data, signed_accounts=None, raise_errors=False):
+	"""Route every entry of a parsed delivery to its Facebook Account
+	
+	When `signed_accounts` is given, entries for pages whose account does not
+	use the app secret that signed the delivery are dropped. With
+	`raise_errors`, handler errors propagate instead of being logged.
+	"""
+	messaging_events = []
+	leadgen_values = {}
+	
+	for entry in data.get("entry", []):
+		route = get_route_by_page_id(entry.get("id"))
+		
+		if not route or (signed_accounts is not None and route.name not in signed_accounts):
+			continue
+		
+		for change in entry.get("changes", []):
+			if not is_change_enabled(route, change):
+				continue
+			if change.get("field") == "leadgen":
+				leadgen_values.setdefault(route.name, []).append(change.get("value", {}))
+			else:
+				process_account_change(route.name, change, raise_errors)
+		
+		if route.features.enable_messenger:
+			for messaging in entry.get("messaging", []):
+				messaging_events.append((route.name, messaging))
+	
+	if messaging_events:
+		process_account_messages(messaging_events, raise_errors)
+	
+	for account, values in leadgen_values.items():
+		process_account_leads(account, values)
+
 def get_account_by_page_id(page_id):
-	accounts = frappe.get_all("Facebook Account", 
-		filters={"page_id": page_id, "enabled": 1})
-	return accounts[0].name if accounts else None
+	route = get_route_by_page_id(page_id)
+	return route.name if route else None
+
+CHANGE_FEATURES = {
+	"leadgen": "enable_leads",
+	"orders": "enable_shop",
+}
 
-def process_account_change(account, change):
+def is_change_enabled(route, change):
+	feature = CHANGE_FEATURES.get(change.get("field"))
+	return bool(feature and route.features.get(feature))
+
+def process_account_change(account, change, raise_errors=False):
 	if change.get("field") == "leadgen":
 		from facebook_integration.api.leads import handle_lead_webhook
 		handle_lead_webhook(account, change.get("value", {}))
 	elif change.get("field") == "orders":
 		from facebook_integration.api.shop import handle_order_webhook
-		handle_order_webhook(account, change.get("value", {}))
+		handle_order_webhook(account, change.get("value", {}), raise_errors=raise_errors)
+
+def process_account_leads(account, leadgen_values):
+	from facebook_integration.api.leads import queue_lead_events
+	queue_lead_events(account, leadgen_values)
+
+def process_account_messages(account_events, raise_errors=False):
+	from facebook_integration.api.messaging import save_message_events
+	save_message_events(account_events, raise_errors=raise_errors)
+
+def process_lead_data(account_name=None, lead_log_name=None):
+	"""Background job to process lead data and create Lead/Contact
+	
+	Drains the account's lead pipeline in micro-batches. `lead_log_name` is
+	accepted for jobs queued by earlier versions, which stored a bare lead
+	log per event.
+	"""
+	from facebook_integration.api.leads import drain_lead_pipeline, refresh_lead_log
+	try:
+		if lead_log_name:
+			refresh_lead_log(lead_log_name)
+			frappe.db.commit()
+		if account_name:
+			drain_lead_pipeline(account_name)
+	except Exception as e:
+		frappe.log_error(f"Lead data processing failed: {str(e)}")
+
+# Webhook journal
+# ---------------
+# In ack-first mode the endpoints only verify and store the raw delivery, then
+# respond. Workers drain the journal in batches. Handlers run with
+# raise_errors, and a delivery is marked Processed only after they succeeded;
+# a failed delivery is retried up to JOURNAL_MAX_ATTEMPTS times and a crash
+# leaves it Processing until it is picked up again once stale
+# (at-least-once; handlers dedupe on Facebook ids).
+
+JOURNAL_DRAIN_JOB_ID = "facebook_webhook_journal_drain"
+JOURNAL_MAX_ATTEMPTS = 5
+JOURNAL_STALE_MINUTES = 10
+JOURNAL_MAX_BATCHES_PER_RUN = 50
+
+PAYLOAD_PROCESSORS = {
+	"legacy": process_webhook_payload,
+	"multi_account": process_multi_account_payload,
+}
 
-def process_account_message(account, messaging):
-	from facebook_integration.api.messaging import handle_message_webhook
-	handle_message_webhook(account, messaging)
+def is_ack_first_enabled():
+	return frappe.utils.cint(frappe.db.get_single_value("Facebook Settings", "ack_first_webhooks", cache=True))
 
-def process_lead_data(lead_log_name):
-	"""Background job to process lead data and create Lead/Contact"""
+def get_journal_batch_size():
+	return frappe.utils.cint(frappe.db.get_single_value("Facebook Settings", "journal_batch_size", cache=True)) or 100
+
+def journal_webhook(endpoint, body, signed_accounts=None):
+	"""Append a raw delivery to the journal and schedule a drain
+	
+	`signed_accounts` is kept with the delivery so the drain applies the
+	same per-app signature check as direct processing.
+	"""
+	event = frappe.new_doc("Facebook Webhook Event")
+	event.endpoint = endpoint
+	event.status = "Queued"
+	event.payload = body
+	if signed_accounts is not None:
+		event.signed_accounts = json.dumps(sorted(signed_accounts))
+	event.insert(ignore_permissions=True)
+	frappe.db.commit()
+	
+	try:
+		enqueue_journal_drain()
+	except Exception as e:
+		# The delivery is stored; the scheduler backstop drains it
+		frappe.log_error(f"Webhook journal drain enqueue failed: {str(e)}")
+	return event.name
+
+def enqueue_journal_drain(continued=False):
+	# A running job blocks deduplicated enqueues of its own job id, so a drain
+	# continues itself under the other of two ids
+	enqueue_event_job(
+		"message",
+		"facebook_integration.api.webhook.drain_webhook_journal",
+		continued=continued,
+		job_id=f"{JOURNAL_DRAIN_JOB_ID}|continued" if continued else JOURNAL_DRAIN_JOB_ID,
+		deduplicate=True
+	)
+
+def drain_webhook_journal(batch_size=None, continued=False):
+	"""Background job to process journaled webhook deliveries in batches"""
+	batch_size = frappe.utils.cint(batch_size) or get_journal_batch_size()
+	requeue_stale_webhook_events()
+	
+	for _batch in range(JOURNAL_MAX_BATCHES_PER_RUN):
+		events = claim_webhook_events(batch_size)
+		if not events:
+			return
+		
+		for event in events:
+			process_journaled_event(event)
+	
+	# More work left than one run should take; continue in a fresh job
+	enqueue_journal_drain(continued=not continued)
+
+def claim_webhook_events(batch_size):
+	"""Lock the oldest queued deliveries and mark them Processing"""
+	names = frappe.db.sql("""
+		SELECT name
+		FROM `tabFacebook Webhook Event`
+		WHERE status = 'Queued'
+		ORDER BY creation
+		LIMIT %s
+		FOR UPDATE SKIP LOCKED
+	""", (batch_size,), pluck=True)
+	
+	if not names:
+		frappe.db.commit()
+		return []
+	
+	frappe.db.sql("""
+		UPDATE `tabFacebook Webhook Event`
+		SET status = 'Processing', attempts = attempts + 1, modified = %s
+		WHERE name IN %s
+	""", (frappe.utils.now(), tuple(names)))
+	frappe.db.commit()
+	
+	return frappe.get_all("Facebook Webhook Event",
+		filters={"name": ["in", names]},
+		fields=["name", "endpoint", "payload", "signed_accounts", "attempts"],
+		order_by="creation asc")
+
+def process_journaled_event(event):
+	"""Run the endpoint's handlers for one journaled delivery"""
 	try:
-		lead_log = frappe.get_doc("Facebook Lead Log", lead_log_name)
-		lead_log.synced = 1
-		lead_log.save(ignore_permissions=True)
+		data = json.loads(event.payload)
+		if event.endpoint == "multi_account":
+			# Deliveries journaled without signing accounts route to no page
+			process_multi_account_payload(data, set(json.loads(event.signed_accounts or "[]")), raise_errors=True)
+		else:
+			PAYLOAD_PROCESSORS[event.endpoint](data, raise_errors=True)
+		frappe.db.set_value("Facebook Webhook Event", event.name, {
+			"status": "Processed",
+			"processed_at": frappe.utils.now(),
+			"error": None
+		}, update_modified=False)
 		frappe.db.commit()
 	except Exception as e:
-		frappe.log_error(f"Lead data processing failed: {str(e)}")
\ No newline at end of file
+		frappe.db.rollback()
+		status = "Failed" if event.attempts >= JOURNAL_MAX_ATTEMPTS else "Queued"
+		frappe.db.set_value("Facebook Webhook Event", event.name, {
+			"status": status,
+			"error": str(e)
+		})
+		frappe.db.commit()
+		if status == "Failed":
+			frappe.log_error(f"Webhook journal event {event.name} failed: {str(e)}")
+
+def requeue_stale_webhook_events():
+	"""Return deliveries abandoned by a crashed worker to the queue"""
+	cutoff = frappe.utils.add_to_date(frappe.utils.now(), minutes=-JOURNAL_STALE_MINUTES)
+	frappe.db.sql("""
+		UPDATE `tabFacebook Webhook Event`
+		SET status = 'Queued'
+		WHERE status = 'Processing' AND modified < %s
+	""", (cutoff,))
+	frappe.db.commit()
+
+@frappe.whitelist()
+def retry_failed_webhook_events():
+	"""Requeue journaled deliveries that exhausted their attempts"""
+	frappe.only_for("System Manager")
+	frappe.db.sql("""
+		UPDATE `tabFacebook Webhook Event`
+		SET status = 'Queued', attempts = 0
+		WHERE status = 'Failed'
+	""")
+	frappe.db.commit()
+	enqueue_journal_drain()
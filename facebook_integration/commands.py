@@ -0,0 +1,29 @@
+import click
+from frappe.commands import get_site, pass_context
+
+@click.command("facebook-backfill-leads")
+@click.argument("account")
+@click.option("--restart", is_flag=True, default=False, help="Start over instead of resuming from the saved cursors")
+@click.option("--enqueue", is_flag=True, default=False, help="Run in a background worker instead of this process")
+@pass_context
+def backfill_leads(context, account, restart=False, enqueue=False):
+	"""Backfill the Lead Ads history of a Facebook Account"""
+	import frappe
+	from facebook_integration.api import lead_backfill
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		if enqueue:
+			lead_backfill.start_lead_backfill(account, restart=int(restart))
+			frappe.db.commit()
+			click.echo(f"Lead backfill of {account} enqueued")
+			return
+
+		report = lead_backfill.backfill_leads(account, restart=restart)
+		frappe.db.commit()
+		click.echo(frappe.as_json(report))
+	finally:
+		frappe.destroy()
+
+commands = [backfill_leads]
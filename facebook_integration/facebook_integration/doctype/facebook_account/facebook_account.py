@@ -1,5 +1,6 @@
 import frappe
 from frappe.model.document import Document
+from facebook_integration.api.accounts import clear_routing_cache
 
 class FacebookAccount(Document):
 	def validate(self):
@@ -7,5 +8,12 @@ class FacebookAccount(Document):
 			self.webhook_url = f"{frappe.utils.get_url()}/api/method/facebook_integration.api.webhook.handle_webhook"
 	
 	def on_update(self):
+		frappe.db.after_commit.add(clear_routing_cache)
 		if self.enabled:
-			frappe.enqueue("facebook_integration.api.webhook.setup_webhook", account=self.name)
\ No newline at end of file
+			frappe.enqueue("facebook_integration.api.webhook.setup_webhook", account=self.name)
+	
+	def on_trash(self):
+		frappe.db.after_commit.add(clear_routing_cache)
+	
+	def after_rename(self, old, new, merge=False):
+		frappe.db.after_commit.add(clear_routing_cache)
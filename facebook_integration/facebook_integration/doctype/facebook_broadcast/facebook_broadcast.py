@@ -0,0 +1,4 @@
+from frappe.model.document import Document
+
+class FacebookBroadcast(Document):
+	pass
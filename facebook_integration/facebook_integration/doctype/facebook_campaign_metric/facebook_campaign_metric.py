@@ -2,13 +2,9 @@ import frappe
 from frappe.model.document import Document
 
 class FacebookCampaignMetric(Document):
-	def validate(self):
-		# Ensure unique combination of campaign_id and date
-		if self.campaign_id and self.date:
-			existing = frappe.db.exists("Facebook Campaign Metric", {
-				"campaign_id": self.campaign_id,
-				"date": self.date,
-				"name": ["!=", self.name]
-			})
-			if existing:
-				frappe.throw(f"Metric for campaign {self.campaign_id} on {self.date} already exists")
\ No newline at end of file
+	pass
+
+def on_doctype_update():
+	# One metric row per campaign and day, enforced by the database
+	frappe.db.add_unique("Facebook Campaign Metric", ["campaign_id", "date"],
+		constraint_name="unique_campaign_date")
@@ -0,0 +1,10 @@
+import frappe
+from frappe.model.document import Document
+
+class FacebookContactIndex(Document):
+	pass
+
+def on_doctype_update():
+	frappe.db.add_unique("Facebook Contact Index", ["match_key", "reference_doctype", "reference_name"],
+		constraint_name="unique_match_key_reference")
+	frappe.db.add_index("Facebook Contact Index", ["reference_doctype", "reference_name"])
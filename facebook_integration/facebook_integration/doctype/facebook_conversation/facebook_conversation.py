@@ -0,0 +1,11 @@
+import frappe
+from frappe.model.document import Document
+
+class FacebookConversation(Document):
+	pass
+
+def on_doctype_update():
+	frappe.db.add_unique("Facebook Conversation", ["facebook_account", "psid"], constraint_name="unique_account_psid")
+	# Inbox scan
+	frappe.db.add_index("Facebook Conversation", ["facebook_account", "last_message_at"])
+	frappe.db.add_index("Facebook Conversation", ["last_message_at"])
@@ -0,0 +1,12 @@
+from frappe.model.document import Document
+from facebook_integration.api.lead_mapping import clear_form_mapping_cache, get_mapping_rows
+
+class FacebookLeadForm(Document):
+	def on_update(self):
+		# Only drop the compiled mapping when it changed
+		before = self.get_doc_before_save()
+		if not before or get_mapping_rows(before) != get_mapping_rows(self):
+			clear_form_mapping_cache(self.name)
+	
+	def on_trash(self):
+		clear_form_mapping_cache(self.name)
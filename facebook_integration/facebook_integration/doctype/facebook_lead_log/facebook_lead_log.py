@@ -7,13 +7,6 @@ class FacebookLeadLog(Document):
 		if not self.created_at:
 			self.created_at = frappe.utils.now()
 	
-	def validate(self):
-		if self.fb_leadgen_id:
-			# Check for duplicate fb_leadgen_id
-			existing = frappe.db.exists("Facebook Lead Log", {"fb_leadgen_id": self.fb_leadgen_id, "name": ["!=", self.name]})
-			if existing:
-				frappe.throw(f"Lead with ID {self.fb_leadgen_id} already exists")
-	
 	def get_lead_data(self):
 		"""Parse and return lead data from JSON"""
 		if self.data:
@@ -21,4 +14,8 @@ class FacebookLeadLog(Document):
 				return json.loads(self.data)
 			except json.JSONDecodeError:
 				return {}
-		return {}
\ No newline at end of file
+		return {}
+
+def on_doctype_update():
+	# Unmapped lead lists, paged on (creation, name)
+	frappe.db.add_index("Facebook Lead Log", ["synced", "facebook_account", "creation"])
@@ -7,10 +7,12 @@ class FacebookMessageLog(Document):
 			self.received_at = frappe.utils.now()
 		elif not self.sent_at and self.direction == "outgoing":
 			self.sent_at = frappe.utils.now()
-	
-	def validate(self):
-		if self.message_id:
-			# Check for duplicate message_id
-			existing = frappe.db.exists("Facebook Message Log", {"message_id": self.message_id, "name": ["!=", self.name]})
-			if existing:
-				frappe.throw(f"Message with ID {self.message_id} already exists")
\ No newline at end of file
+
+def on_doctype_update():
+	# Outbound queue scans
+	frappe.db.add_index("Facebook Message Log", ["status", "facebook_account", "creation"])
+	# Thread reads and message lists, paged on (creation, name)
+	frappe.db.add_index("Facebook Message Log", ["conversation", "creation"])
+	frappe.db.add_index("Facebook Message Log", ["facebook_account", "creation"])
+	# Change feed, paged on (modified, name)
+	frappe.db.add_index("Facebook Message Log", ["facebook_account", "modified"])
@@ -1,5 +1,6 @@
 import frappe
 from frappe.model.document import Document
+from facebook_integration.api.accounts import clear_routing_cache
 
 class FacebookSettings(Document):
 	def validate(self):
@@ -9,4 +10,7 @@ class FacebookSettings(Document):
 		# Set webhook URL
 		if not self.webhook_url:
 			site_url = frappe.utils.get_url()
-			self.webhook_url = f"{site_url}/api/method/facebook_integration.api.webhook"
\ No newline at end of file
+			self.webhook_url = f"{site_url}/api/method/facebook_integration.api.webhook"
+	
+	def on_update(self):
+		frappe.db.after_commit.add(clear_routing_cache)
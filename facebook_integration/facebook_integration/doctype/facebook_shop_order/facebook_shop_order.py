@@ -1,10 +1,13 @@
 import frappe
 from frappe.model.document import Document
+from facebook_integration.api.accounts import get_account_context
+from facebook_integration.queues import enqueue_account_job
 
 class FacebookShopOrder(Document):
 	def after_insert(self):
 		if not self.sales_order:
-			frappe.enqueue("facebook_integration.api.shop.create_sales_order", order_id=self.name)
+			enqueue_account_job("order", "facebook_integration.api.shop.create_sales_order",
+				self.facebook_account, order_id=self.name)
 	
 	def create_sales_order(self):
 		if self.sales_order:
@@ -17,7 +20,7 @@ class FacebookShopOrder(Document):
 		so = frappe.new_doc("Sales Order")
 		so.customer = customer
 		so.delivery_date = frappe.utils.add_days(self.order_date, 7)
-		so.company = frappe.db.get_value("Facebook Account", self.facebook_account, "company")
+		so.company = get_account_context(self.facebook_account).company
 		
 		for item in self.items:
 			so.append("items", {
@@ -0,0 +1,10 @@
+import frappe
+from frappe.model.document import Document
+
+class FacebookWebhookEvent(Document):
+	def before_insert(self):
+		if not self.received_at:
+			self.received_at = frappe.utils.now()
+
+def on_doctype_update():
+	frappe.db.add_index("Facebook Webhook Event", ["status", "creation"])
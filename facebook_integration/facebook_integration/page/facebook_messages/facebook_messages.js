@@ -11,6 +11,12 @@ frappe.pages['facebook-messages'].on_page_load = function(wrapper) {
 class FacebookMessages {
 	constructor(page) {
 		this.page = page;
+		this.accounts = [];
+		// Change feed cursor per account, advanced by realtime deltas
+		this.cursors = {};
+		this.conversations = {};
+		this.messages = {};
+		this.current_conversation = null;
 		this.make();
 	}
 
@@ -63,6 +69,10 @@ class FacebookMessages {
 			if (e.which === 13) this.send_message();
 		});
 		$('#account-filter').change(() => this.load_conversations());
+
+		frappe.realtime.on('facebook_message_changes', (data) => this.apply_changes(data));
+		// Catch up on changes missed while the socket was down
+		frappe.realtime.socket && frappe.realtime.socket.on('connect', () => this.fetch_changes());
 	}
 
 	load_accounts() {
@@ -75,11 +85,14 @@ class FacebookMessages {
 			},
 			callback: (r) => {
 				if (r.message) {
+					this.accounts = r.message.map(acc => acc.name);
 					let options = '<option value="">All Accounts</option>';
 					r.message.forEach(acc => {
-						options += `<option value="${acc.name}">${acc.account_name}</option>`;
+						options += `<option value="${frappe.utils.escape_html(acc.name)}">${frappe.utils.escape_html(acc.account_name)}</option>`;
+						frappe.realtime.doc_subscribe('Facebook Account', acc.name);
 					});
 					$('#account-filter').html(options);
+					this.fetch_changes();
 				}
 			}
 		});
@@ -88,72 +101,122 @@ class FacebookMessages {
 	load_conversations() {
 		const account = $('#account-filter').val();
 		frappe.call({
-			method: 'facebook_integration.api.messaging.get_messages',
+			method: 'facebook_integration.api.conversations.get_inbox',
 			args: {account_name: account, limit: 50},
 			callback: (r) => {
 				if (r.message && r.message.success) {
-					this.render_conversations(r.message.messages);
+					this.conversations = {};
+					r.message.conversations.forEach(conv => this.conversations[conv.name] = conv);
+					this.render_conversations();
 				}
 			}
 		});
 	}
 
-	render_conversations(messages) {
-		const conversations = {};
-		messages.forEach(msg => {
-			const key = msg.direction === 'incoming' ? msg.sender_id : msg.recipient_id;
-			if (!conversations[key]) {
-				conversations[key] = {
-					id: key,
-					name: msg.sender_name || key,
-					last_message: msg.content,
-					time: msg.received_at || msg.sent_at
-				};
-			}
-		});
+	render_conversations() {
+		const conversations = Object.values(this.conversations)
+			.sort((a, b) => (b.last_message_at || '').localeCompare(a.last_message_at || ''));
 
+		const escape = frappe.utils.escape_html;
 		let html = '';
-		Object.values(conversations).forEach(conv => {
+		conversations.forEach(conv => {
 			html += `
-				<div class="conversation-item p-2 border-bottom" data-id="${conv.id}">
-					<strong>${conv.name}</strong>
-					<p class="text-muted small">${conv.last_message}</p>
-					<small>${conv.time}</small>
+				<div class="conversation-item p-2 border-bottom" data-name="${escape(conv.name)}">
+					<strong>${escape(conv.sender_name || conv.psid)}</strong>
+					${conv.unread_count ? `<span class="badge badge-primary float-right">${cint(conv.unread_count)}</span>` : ''}
+					<p class="text-muted small">${escape(conv.last_message_preview || '')}</p>
+					<small>${escape(conv.last_message_at || '')}</small>
 				</div>
 			`;
 		});
 
 		$('#conversations-list').html(html);
 		$('.conversation-item').click((e) => {
-			const id = $(e.currentTarget).data('id');
-			this.load_conversation(id);
+			const name = $(e.currentTarget).attr('data-name');
+			this.load_conversation(this.conversations[name]);
 		});
 	}
 
-	load_conversation(sender_id) {
-		const account = $('#account-filter').val();
+	load_conversation(conv) {
 		frappe.call({
 			method: 'facebook_integration.api.messaging.get_conversation',
-			args: {sender_id: sender_id, account_name: account},
+			args: {sender_id: conv.psid, account_name: conv.facebook_account},
 			callback: (r) => {
 				if (r.message && r.message.success) {
-					this.render_messages(r.message.messages);
-					this.current_sender = sender_id;
-					$('#conversation-title').text(`Conversation with ${sender_id}`);
+					this.current_conversation = conv;
+					this.messages = {};
+					r.message.messages.forEach(msg => this.messages[msg.name] = msg);
+					this.render_messages();
+					$('#conversation-title').text(`Conversation with ${conv.sender_name || conv.psid}`);
+					this.mark_read(conv);
 				}
 			}
 		});
 	}
 
-	render_messages(messages) {
+	mark_read(conv) {
+		if (!conv.unread_count) return;
+		frappe.call({
+			method: 'facebook_integration.api.conversations.mark_conversation_read',
+			args: {conversation: conv.name},
+			callback: () => {
+				conv.unread_count = 0;
+				this.render_conversations();
+			}
+		});
+	}
+
+	fetch_changes(accounts) {
+		(accounts || this.accounts).forEach(account => {
+			frappe.call({
+				method: 'facebook_integration.api.messaging.get_message_changes',
+				args: {account_name: account, cursor: this.cursors[account]},
+				callback: (r) => {
+					if (r.message && r.message.success) {
+						this.apply_changes(Object.assign({account: account}, r.message));
+						if (r.message.has_more) this.fetch_changes([account]);
+					}
+				}
+			});
+		});
+	}
+
+	apply_changes(data) {
+		if (data.cursor) this.cursors[data.account] = data.cursor;
+
+		const account = $('#account-filter').val();
+		if (account && account !== data.account) return;
+
+		(data.conversations || []).forEach(conv => {
+			const current = this.current_conversation && this.current_conversation.name === conv.name;
+			// The open thread is being read
+			if (current) conv.unread_count = 0;
+			this.conversations[conv.name] = conv;
+			if (current) this.current_conversation = conv;
+		});
+		if ((data.conversations || []).length) this.render_conversations();
+
+		const thread = (data.messages || []).filter(msg =>
+			this.current_conversation && msg.conversation === this.current_conversation.name);
+		if (thread.length) {
+			thread.forEach(msg => this.messages[msg.name] = Object.assign(this.messages[msg.name] || {}, msg));
+			this.render_messages();
+		}
+	}
+
+	render_messages() {
+		const messages = Object.values(this.messages)
+			.sort((a, b) => (a.creation || '').localeCompare(b.creation || ''));
+
+		const escape = frappe.utils.escape_html;
 		let html = '';
 		messages.forEach(msg => {
 			const isOutgoing = msg.direction === 'outgoing';
 			html += `
 				<div class="message ${isOutgoing ? 'outgoing' : 'incoming'} mb-2">
 					<div class="p-2 rounded ${isOutgoing ? 'bg-primary text-white ml-auto' : 'bg-light'}" style="max-width: 70%;">
-						${msg.content}
-						<small class="d-block mt-1">${msg.received_at || msg.sent_at}</small>
+						${escape(msg.content || '')}
+						<small class="d-block mt-1">${escape(msg.received_at || msg.sent_at || '')}${isOutgoing && msg.status !== 'sent' ? ` · ${escape(msg.status)}` : ''}</small>
 					</div>
 				</div>
 			`;
@@ -164,23 +227,23 @@ class FacebookMessages {
 
 	send_message() {
 		const message = $('#message-input').val().trim();
-		const account = $('#account-filter').val();
-		
-		if (!message || !this.current_sender || !account) return;
+		const conv = this.current_conversation;
+
+		if (!message || !conv) return;
 
 		frappe.call({
 			method: 'facebook_integration.api.messaging.send_message',
 			args: {
-				account_name: account,
-				recipient_id: this.current_sender,
+				account_name: conv.facebook_account,
+				recipient_id: conv.psid,
 				message_text: message
 			},
 			callback: (r) => {
+				// The queued message arrives through the realtime delta
 				if (r.message && r.message.success) {
 					$('#message-input').val('');
-					this.load_conversation(this.current_sender);
 				}
 			}
 		});
 	}
-}
\ No newline at end of file
+}
@@ -145,19 +145,41 @@ after_install = "facebook_integration.install.after_install"
 # 	}
 # }
 
+doc_events = {
+	"Lead": {
+		"on_update": "facebook_integration.api.contacts.update_contact_index",
+		"on_trash": "facebook_integration.api.contacts.remove_from_contact_index"
+	},
+	"Contact": {
+		"on_update": "facebook_integration.api.contacts.update_contact_index",
+		"on_trash": "facebook_integration.api.contacts.remove_from_contact_index"
+	},
+	"Customer": {
+		"on_update": "facebook_integration.api.contacts.update_contact_index",
+		"on_trash": "facebook_integration.api.contacts.remove_from_contact_index"
+	}
+}
+
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
+	"all": [
+		"facebook_integration.api.webhook.drain_webhook_journal",
+		"facebook_integration.api.leads.enqueue_lead_pipelines",
+		"facebook_integration.api.messaging.enqueue_outbound_senders",
+		"facebook_integration.api.broadcast.resume_stalled_broadcasts",
+		"facebook_integration.queues.enqueue_deferred_jobs"
+	],
 	"daily": [
-		"facebook_integration.tasks.sync_insights"
+		"facebook_integration.tasks.enqueue_sync_insights"
 	],
 	"cron": {
 		"*/5 * * * *": [
 			"facebook_integration.tasks.fetch_leads"
 		],
 		"0 1 * * *": [
-			"facebook_integration.tasks.sync_shop_data"
+			"facebook_integration.tasks.enqueue_sync_shop_data"
 		],
 		"0 2 * * 0": [
 			"facebook_integration.tasks.cleanup_old_logs"
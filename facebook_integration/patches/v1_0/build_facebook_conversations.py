@@ -0,0 +1,31 @@
+import frappe
+from facebook_integration.api.conversations import update_conversations
+
+PAGE_SIZE = 5000
+
+def execute():
+	"""Link existing message logs to conversations and build the conversation rows"""
+	frappe.db.sql("""
+		UPDATE `tabFacebook Message Log`
+		SET `conversation` = CONCAT(`facebook_account`, '-',
+			CASE WHEN `direction` = 'incoming' THEN `sender_id` ELSE `recipient_id` END)
+		WHERE `conversation` IS NULL
+			AND `facebook_account` IS NOT NULL
+			AND (CASE WHEN `direction` = 'incoming' THEN `sender_id` ELSE `recipient_id` END) IS NOT NULL
+	""")
+	
+	start = 0
+	while True:
+		message_logs = frappe.get_all("Facebook Message Log",
+			filters={"conversation": ["is", "set"]},
+			fields=["facebook_account", "sender_id", "sender_name", "recipient_id", "direction",
+				"content", "message_type", "received_at", "sent_at"],
+			order_by="creation asc, name asc",
+			limit_start=start,
+			limit_page_length=PAGE_SIZE)
+		if not message_logs:
+			break
+		
+		# History is not unread
+		update_conversations(message_logs, count_unread=False)
+		start += PAGE_SIZE
@@ -0,0 +1,128 @@
+import frappe
+import time
+
+# Background work is split into event classes. Each class maps to an RQ queue;
+# bench workers listen to "short,default,long" in that order, so messages are
+# always dequeued before leads/orders, and those before bulk syncs. Sites with
+# dedicated workers can remap classes with the `facebook_integration_queues`
+# site config key, e.g. {"message": "facebook_messages"}.
+EVENT_QUEUES = {
+	"message": "short",
+	"lead": "default",
+	"order": "default",
+	"sync": "long",
+}
+
+# How many jobs of one class may run at the same time for one account.
+# Override with the `facebook_account_concurrency` site config key.
+ACCOUNT_CONCURRENCY = {
+	"message": 4,
+	"lead": 2,
+	"order": 2,
+	"sync": 1,
+}
+
+SLOT_TTL = 30 * 60
+
+# Jobs over their account's cap are parked in a Redis sorted set and
+# re-enqueued by the scheduler once due, with exponential backoff, so no
+# worker sleeps on them. After MAX_DEFERRALS a job is given up and logged.
+DEFERRED_JOBS_KEY = "facebook_deferred_account_jobs"
+DEFERRAL_BACKOFF = 5
+MAX_DEFERRAL_DELAY = 5 * 60
+MAX_DEFERRALS = 10
+
+def get_queue(event_class):
+	queues = frappe.conf.get("facebook_integration_queues") or {}
+	return queues.get(event_class) or EVENT_QUEUES[event_class]
+
+def get_account_concurrency(event_class):
+	limits = frappe.conf.get("facebook_account_concurrency") or {}
+	return frappe.utils.cint(limits.get(event_class)) or ACCOUNT_CONCURRENCY[event_class]
+
+def enqueue_event_job(event_class, method, **kwargs):
+	"""Enqueue a job on the queue of its event class"""
+	return frappe.enqueue(method, queue=get_queue(event_class), **kwargs)
+
+def enqueue_account_job(event_class, method, account, **kwargs):
+	"""Enqueue a job that counts against the account's concurrency cap
+
+	Jobs without an account are not capped.
+	"""
+	if not account:
+		return enqueue_event_job(event_class, method, **kwargs)
+
+	return enqueue_event_job(event_class, "facebook_integration.queues.run_account_job",
+		job_event_class=event_class,
+		account=account,
+		job_method=method,
+		job_kwargs=kwargs)
+
+def run_account_job(job_event_class, account, job_method, job_kwargs=None, deferrals=0):
+	"""Run an account job if the account has a free slot, otherwise defer it
+
+	Deferred jobs are re-enqueued after a backoff, so jobs of other accounts
+	are served meanwhile and one busy page cannot hold every worker.
+	"""
+	if not acquire_account_slot(job_event_class, account):
+		defer_account_job(job_event_class, account, job_method, job_kwargs, deferrals + 1)
+		return
+
+	try:
+		frappe.get_attr(job_method)(**(job_kwargs or {}))
+	finally:
+		release_account_slot(job_event_class, account)
+
+def defer_account_job(job_event_class, account, job_method, job_kwargs, deferrals):
+	if deferrals > MAX_DEFERRALS:
+		frappe.log_error(f"{job_method} for {account} gave up after {MAX_DEFERRALS} deferrals: account is at its {job_event_class} concurrency cap")
+		return
+
+	job = frappe.as_json({
+		"id": frappe.generate_hash(length=10),
+		"job_event_class": job_event_class,
+		"account": account,
+		"job_method": job_method,
+		"job_kwargs": job_kwargs,
+		"deferrals": deferrals,
+	}, indent=None)
+	due = time.time() + min(DEFERRAL_BACKOFF * 2 ** (deferrals - 1), MAX_DEFERRAL_DELAY)
+	cache = frappe.cache()
+	cache.zadd(cache.make_key(DEFERRED_JOBS_KEY), {job: due})
+
+def enqueue_deferred_jobs():
+	"""Scheduler entry point: re-enqueue deferred account jobs that are due"""
+	cache = frappe.cache()
+	key = cache.make_key(DEFERRED_JOBS_KEY)
+	for job in cache.zrangebyscore(key, 0, time.time()):
+		# Only the process that removes the entry enqueues it
+		if not cache.zrem(key, job):
+			continue
+		job = frappe.parse_json(frappe.safe_decode(job))
+		job.pop("id", None)
+		enqueue_event_job(job["job_event_class"], "facebook_integration.queues.run_account_job", **job)
+
+def get_slot_key(event_class, account):
+	return frappe.cache().make_key(f"facebook_account_slots|{event_class}|{account}")
+
+def acquire_account_slot(event_class, account):
+	cache = frappe.cache()
+	key = get_slot_key(event_class, account)
+
+	# The TTL is set only when the counter is created, so slots leaked by a
+	# killed worker expire even while other jobs keep asking for a slot
+	pipe = cache.pipeline()
+	pipe.set(key, 0, nx=True, ex=SLOT_TTL)
+	pipe.incr(key)
+	running = pipe.execute()[1]
+
+	if running > get_account_concurrency(event_class):
+		cache.decr(key)
+		return False
+	return True
+
+def release_account_slot(event_class, account):
+	cache = frappe.cache()
+	key = get_slot_key(event_class, account)
+	if cache.decr(key) < 0:
+		cache.delete(key)
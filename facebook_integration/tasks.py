@@ -1,67 +1,119 @@
 import frappe
+import time
+from concurrent.futures import as_completed
 from datetime import datetime, timedelta
 from facebook_integration.api.insights import sync_campaign_insights
 from facebook_integration.api.leads import fetch_leads as api_fetch_leads
 from facebook_integration.api.shop import sync_products, sync_inventory
+from facebook_integration.queues import enqueue_event_job
+from facebook_integration.utils import SiteThreadPool, account_lease
+
+def enqueue_sync_insights():
+	"""Scheduler entry point: run the insights sync on the bulk sync queue"""
+	enqueue_event_job("sync", "facebook_integration.tasks.sync_insights")
+
+def enqueue_sync_shop_data():
+	"""Scheduler entry point: run the shop sync on the bulk sync queue"""
+	enqueue_event_job("sync", "facebook_integration.tasks.sync_shop_data")
 
 def sync_insights():
 	"""Daily task to sync Facebook campaign insights"""
 	try:
-		accounts = frappe.get_all("Facebook Account", 
-			filters={"enabled": 1, "enable_ads": 1},
-			fields=["name"])
-		
-		for account in accounts:
-			try:
-				sync_campaign_insights(account.name)
-				frappe.logger().info(f"Synced insights for account: {account.name}")
-			except Exception as e:
-				frappe.log_error(f"Insights sync failed for {account.name}: {str(e)}")
-		
-		frappe.db.commit()
-		
+		run_for_accounts("sync_insights", {"enable_ads": 1}, sync_campaign_insights)
 	except Exception as e:
 		frappe.log_error(f"Facebook insights sync task failed: {str(e)}")
 
 def fetch_leads():
 	"""Periodic task to fetch Facebook leads"""
 	try:
-		accounts = frappe.get_all("Facebook Account", 
-			filters={"enabled": 1, "enable_leads": 1},
-			fields=["name"])
-		
-		for account in accounts:
-			try:
-				result = api_fetch_leads(account.name, limit=25)
-				frappe.logger().info(f"Fetched leads for {account.name}: {result}")
-			except Exception as e:
-				frappe.log_error(f"Lead fetch failed for {account.name}: {str(e)}")
-		
-		frappe.db.commit()
-		
+		run_for_accounts("fetch_leads", {"enable_leads": 1}, fetch_account_leads)
 	except Exception as e:
 		frappe.log_error(f"Facebook lead fetch task failed: {str(e)}")
 
 def sync_shop_data():
 	"""Sync Facebook Shop products and inventory"""
 	try:
-		accounts = frappe.get_all("Facebook Account", 
-			filters={"enabled": 1, "enable_shop": 1},
-			fields=["name"])
-		
-		for account in accounts:
-			try:
-				sync_products(account.name)
-				sync_inventory(account.name)
-				frappe.logger().info(f"Synced shop data for account: {account.name}")
-			except Exception as e:
-				frappe.log_error(f"Shop sync failed for {account.name}: {str(e)}")
-		
-		frappe.db.commit()
-		
+		run_for_accounts("sync_shop_data", {"enable_shop": 1}, sync_account_shop)
 	except Exception as e:
 		frappe.log_error(f"Facebook shop sync task failed: {str(e)}")
 
+def fetch_account_leads(account_name):
+	return api_fetch_leads(account_name, limit=25)
+
+def sync_account_shop(account_name):
+	products = sync_products(account_name)
+	inventory = sync_inventory(account_name)
+	return {
+		"status": "error" if "error" in (products.get("status"), inventory.get("status")) else "success",
+		"products": products,
+		"inventory": inventory
+	}
+
+# Multi-account sync engine
+# -------------------------
+# Scheduled syncs run the per-account function for every enabled account on
+# a bounded thread pool. Each thread opens its own site connection and
+# commits or rolls back on its own, so one failing account does not affect
+# the others. The pool size is the `facebook_sync_concurrency` site config
+# key. Each (task, account) run holds a lease; when the previous run for an
+# account is still going, the account is skipped instead of synced twice.
+
+DEFAULT_SYNC_CONCURRENCY = 4
+
+def get_sync_concurrency():
+	return frappe.utils.cint(frappe.conf.get("facebook_sync_concurrency")) or DEFAULT_SYNC_CONCURRENCY
+
+def run_for_accounts(task_name, filters, method):
+	"""Run `method(account_name)` for all matching enabled accounts in parallel
+	
+	Returns and logs the wall-clock time and per-account status and timing.
+	"""
+	accounts = frappe.get_all("Facebook Account",
+		filters={"enabled": 1, **filters},
+		pluck="name")
+	
+	started = time.monotonic()
+	results = {}
+	
+	if accounts:
+		with SiteThreadPool(max_workers=min(get_sync_concurrency(), len(accounts))) as pool:
+			futures = {
+				pool.submit(run_account_task, task_name, method, account): account
+				for account in accounts
+			}
+			for future in as_completed(futures):
+				results[futures[future]] = future.result()
+	
+	report = {
+		"task": task_name,
+		"accounts": len(accounts),
+		"failed": sum(1 for result in results.values() if result["status"] not in ("success", "skipped")),
+		"skipped": sum(1 for result in results.values() if result["status"] == "skipped"),
+		"wall_clock": round(time.monotonic() - started, 3),
+		"timings": results
+	}
+	frappe.logger("facebook_integration").info(report)
+	return report
+
+def run_account_task(task_name, method, account):
+	"""Run one account's sync in its own transaction on a SiteThreadPool worker"""
+	started = time.monotonic()
+	try:
+		with account_lease(task_name, account) as acquired:
+			if not acquired:
+				return {"status": "skipped", "duration": 0, "reason": "previous run still in progress"}
+			
+			result = method(account)
+			frappe.db.commit()
+		
+		status = "error" if isinstance(result, dict) and result.get("status") == "error" else "success"
+		return {"status": status, "duration": round(time.monotonic() - started, 3), "result": result}
+	except Exception as e:
+		frappe.db.rollback()
+		frappe.log_error(f"{task_name} failed for {account}: {str(e)}")
+		frappe.db.commit()
+		return {"status": "failed", "duration": round(time.monotonic() - started, 3), "error": str(e)}
+
 def cleanup_old_logs():
 	"""Weekly task to cleanup old logs"""
 	try:
@@ -93,6 +145,13 @@ def cleanup_old_logs():
 		for metric_name in old_metrics:
 			frappe.delete_doc("Facebook Campaign Metric", metric_name, ignore_permissions=True)
 		
+		# Cleanup processed webhook journal entries (keep 7 days)
+		journal_cutoff = frappe.utils.add_days(frappe.utils.nowdate(), -7)
+		frappe.db.delete("Facebook Webhook Event", {
+			"status": "Processed",
+			"creation": ["<", journal_cutoff]
+		})
+		
 		frappe.logger().info(f"Cleaned up {len(old_messages)} messages, {len(old_leads)} leads, {len(old_metrics)} metrics")
 		frappe.db.commit()
 		
@@ -0,0 +1,276 @@
+import frappe
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from frappe.model.naming import parse_naming_series
+
+def bulk_insert_docs(doctype, rows, ignore_duplicates=True):
+	"""Insert plain dict rows in one multi-row INSERT, bypassing controllers
+
+	Names are generated here: a block of naming series numbers is reserved in
+	one query for naming_series doctypes, other doctypes get hash names.
+	Returns the rows with `name` set, in input order. With
+	`ignore_duplicates`, rows skipped for clashing with a unique key are
+	left out.
+	"""
+	if not rows:
+		return []
+
+	meta = frappe.get_meta(doctype)
+	now = frappe.utils.now()
+	user = frappe.session.user
+
+	template = {k: v for k, v in frappe.new_doc(doctype).get_valid_dict().items() if v is not None}
+	template.update({
+		"creation": now,
+		"modified": now,
+		"owner": user,
+		"modified_by": user,
+		"docstatus": 0,
+	})
+
+	if meta.autoname == "naming_series:":
+		series = template.get("naming_series") or meta.get_field("naming_series").options.split("\n")[0]
+		names = reserve_series_names(series, len(rows))
+	else:
+		names = [frappe.generate_hash(length=10) for _row in rows]
+
+	docs = []
+	for name, row in zip(names, rows):
+		doc = {**template, **row}
+		doc["name"] = name
+		docs.append(doc)
+
+	fields = sorted({key for doc in docs for key in doc})
+	values = [[doc.get(field) for field in fields] for doc in docs]
+	frappe.db.bulk_insert(doctype, fields, values, ignore_duplicates=ignore_duplicates)
+
+	if ignore_duplicates:
+		# Names are fresh, so only the rows that were inserted carry them
+		inserted = set(frappe.get_all(doctype, filters={"name": ["in", names]}, pluck="name"))
+		docs = [doc for doc in docs if doc["name"] in inserted]
+
+	return docs
+
+def reserve_series_names(series, count, digits=5):
+	"""Reserve `count` consecutive names of a naming series with one counter update"""
+	prefix = parse_naming_series(series.rstrip("."))
+
+	current = frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name`=%s FOR UPDATE", (prefix,))
+	if current and current[0][0] is not None:
+		start = frappe.utils.cint(current[0][0])
+		frappe.db.sql("UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name`=%s", (count, prefix))
+	else:
+		start = 0
+		frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (prefix, count))
+
+	return [prefix + ("%0" + str(digits) + "d") % (start + i) for i in range(1, count + 1)]
+
+# Keyset pagination
+# -----------------
+# List APIs page on (timestamp, name) instead of OFFSET, so deep pages cost
+# the same as the first. A cursor is "<timestamp>|<name>" of the last row
+# returned.
+
+MAX_PAGE_SIZE = 200
+
+def get_page_size(limit, default=50):
+	return min(frappe.utils.cint(limit) or default, MAX_PAGE_SIZE)
+
+def get_keyset_filters(cursor, field="creation", ascending=False):
+	"""Return (filters, or_filters) selecting the rows after `cursor`
+	
+	(field, name) past the cursor is expressed as
+	field >= value AND (field > value OR name > cursor name), which fits
+	frappe filters and still seeks on an index ending in `field`.
+	"""
+	if not cursor:
+		return [], []
+	
+	value, name = cursor.split("|", 1)
+	op = ">" if ascending else "<"
+	return [[field, f"{op}=", value]], [[field, op, value], ["name", op, name]]
+
+def get_next_cursor(rows, limit, field="creation"):
+	"""Return the cursor after the last row, or None on the last page"""
+	if len(rows) < limit:
+		return None
+	return f"{rows[-1][field]}|{rows[-1]['name']}"
+
+# Idempotency filter
+# ------------------
+# Facebook redelivers webhooks. Ids that were already persisted are remembered
+# in Redis for a while so redeliveries are dropped before any document is
+# built. The unique keys on the doctypes remain the final guard.
+
+IDEMPOTENCY_TTL = 2 * 24 * 60 * 60
+
+def get_idempotency_key(kind, key):
+	return f"facebook_seen|{kind}|{key}"
+
+def filter_unseen(kind, keys):
+	"""Return the keys not recently persisted for `kind`, preserving order"""
+	keys = [key for key in keys if key]
+	if not keys:
+		return []
+
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	for key in keys:
+		pipe.exists(cache.make_key(get_idempotency_key(kind, key)))
+
+	return [key for key, seen in zip(keys, pipe.execute()) if not seen]
+
+def is_seen(kind, key):
+	return bool(key) and not filter_unseen(kind, [key])
+
+def mark_seen(kind, keys, ttl=IDEMPOTENCY_TTL):
+	"""Remember keys as persisted; call after the transaction is committed"""
+	keys = [key for key in keys if key]
+	if not keys:
+		return
+
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	for key in keys:
+		pipe.set(cache.make_key(get_idempotency_key(kind, key)), 1, ex=ttl)
+	pipe.execute()
+
+def mark_seen_after_commit(kind, keys, ttl=IDEMPOTENCY_TTL):
+	"""Remember keys as persisted once the current transaction commits"""
+	keys = list(keys)
+	frappe.db.after_commit.add(lambda: mark_seen(kind, keys, ttl))
+
+# Leases
+# ------
+# A lease is a Redis key holding a random token, set with NX and an expiry.
+# While held, a heartbeat thread extends the expiry; if the holder dies the
+# lease expires and the next run can take over. Renew and release only touch
+# the key while it still holds our token.
+
+LEASE_TTL = 120
+
+RENEW_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+	return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+	return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+class Lease:
+	def __init__(self, name, ttl=LEASE_TTL):
+		self.cache = frappe.cache()
+		# Resolve the site-prefixed key here; the heartbeat thread has no site context
+		self.key = self.cache.make_key(name)
+		self.ttl = ttl
+		self.token = frappe.generate_hash(length=16)
+		self._stop = threading.Event()
+		self._heartbeat = None
+
+	def acquire(self):
+		if not self.cache.set(self.key, self.token, nx=True, ex=self.ttl):
+			return False
+		self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+		self._heartbeat.start()
+		return True
+
+	def _beat(self):
+		renew = self.cache.register_script(RENEW_LEASE_SCRIPT)
+		while not self._stop.wait(self.ttl / 3):
+			if not renew(keys=[self.key], args=[self.token, self.ttl]):
+				return
+
+	def release(self):
+		self._stop.set()
+		if self._heartbeat:
+			self._heartbeat.join()
+		self.cache.register_script(RELEASE_LEASE_SCRIPT)(keys=[self.key], args=[self.token])
+
+@contextmanager
+def account_lease(task, account, ttl=LEASE_TTL):
+	"""Hold the lease for (task, account); yields False if another run holds it"""
+	lease = Lease(f"facebook_lease|{task}|{account}", ttl)
+	if not lease.acquire():
+		yield False
+		return
+	try:
+		yield True
+	finally:
+		lease.release()
+
+# Site thread pool
+# ----------------
+# Worker threads have no site context of their own. Each worker of a
+# SiteThreadPool runs frappe.init and frappe.connect once when it starts and
+# frappe.destroy when the pool shuts down, so a thread keeps one database
+# connection for all its tasks. Tasks commit or roll back on their own.
+
+class SiteThreadPool:
+	"""A ThreadPoolExecutor-like pool of workers bound to the current site
+
+	`submit` returns concurrent.futures.Future objects; use the pool as a
+	context manager to shut the workers down.
+	"""
+
+	def __init__(self, max_workers):
+		self.site = frappe.local.site
+		self.sites_path = frappe.local.sites_path
+		self.max_workers = max_workers
+		self.tasks = queue.Queue()
+		self.threads = []
+
+	def submit(self, fn, *args, **kwargs):
+		future = Future()
+		self.tasks.put((future, fn, args, kwargs))
+		if len(self.threads) < self.max_workers:
+			thread = threading.Thread(target=self._work, daemon=True)
+			thread.start()
+			self.threads.append(thread)
+		return future
+
+	def _work(self):
+		try:
+			frappe.init(site=self.site, sites_path=self.sites_path)
+			frappe.connect()
+			error = None
+		except Exception as e:
+			# Fail this worker's tasks instead of leaving their futures pending
+			error = e
+
+		try:
+			while True:
+				task = self.tasks.get()
+				if task is None:
+					return
+				future, fn, args, kwargs = task
+				if not future.set_running_or_notify_cancel():
+					continue
+				if error:
+					future.set_exception(error)
+					continue
+				try:
+					future.set_result(fn(*args, **kwargs))
+				except Exception as e:
+					future.set_exception(e)
+		finally:
+			frappe.destroy()
+
+	def shutdown(self):
+		for _thread in self.threads:
+			self.tasks.put(None)
+		for thread in self.threads:
+			thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()